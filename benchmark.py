@@ -0,0 +1,272 @@
+import argparse
+import functools
+import glob
+import http.server
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from manifest import LAUNCHER_FILES, write_manifest
+
+"""
+Measures launcher start-up without touching github.com. Builds a fake ClaverMessageBoard (local git repository, VERSION.txt, requirements file)
+and a fake ClaverLauncher release, serves the raw files and the releases API from a local HTTP server and runs init.py through:
+    cold_install      - empty node directory
+    warm_start        - nothing has changed
+    app_upgrade       - a new version of the app has been published. It is staged in the background.
+    staged_switch     - the staged version is switched in
+    launcher_update   - a new version of the launcher has been published
+    lan_cache_install - a second launcher instance runs cache_server.py. A new node installs the app and its wheels from it alone.
+Usage: python benchmark.py [--find-links WHEEL_DIR] [--json REPORT]
+The interpreter running the benchmark must be able to run init.py (virtualenv, psutil and requests installed or installable).
+Pass --find-links to install the launcher's own modules into the venv from a local wheel directory instead of the package index.
+"""
+
+APP_NAME = "ClaverMessageBoard"
+ORGANISATION = "mccolm-robotics"
+
+APP_ENTRY_POINT = '''
+class ClaverMessageBoard:
+    """ Stand-in for the real app. Reports "no further action" and exits as soon as it is run. """
+    def __init__(self, exit_status_callback):
+        self.exit_status_callback = exit_status_callback
+
+    def run(self):
+        self.exit_status_callback(0)
+        return 0
+'''
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    """ Serves the stand-in for raw.githubusercontent.com and api.github.com without logging every request """
+    def log_message(self, format, *args):
+        pass
+
+
+class Benchmark:
+    def __init__(self, find_links=None):
+        self.source_dir = os.path.dirname(os.path.abspath(__file__))    # Launcher checkout being measured
+        self.work_dir = tempfile.mkdtemp(prefix="claver-benchmark-")
+        self.remote_dir = self.work_dir + "/remote"     # Stand-in for github.com (git repositories)
+        self.www_dir = self.work_dir + "/www"   # Stand-in for raw.githubusercontent.com and the releases API
+        self.app_work_tree = self.work_dir + "/app-src"     # Where new versions of the fake app are committed
+        self.node_dir = self.work_dir + "/node"     # The node the launcher is installed on
+        self.cache_node_dir = self.work_dir + "/cache-node"     # Second launcher instance, running cache_server.py
+        self.lan_node_dir = self.work_dir + "/lan-node"     # Node that only reaches the public hosts through the cache
+        self.find_links = find_links
+        self.app_version = [0, 1, 0]
+        self.launcher_version = None
+        self.server = None
+        self.cache_server = None
+        self.results = []
+
+    def run(self):
+        """ Runs every scenario in order. Each scenario starts from the state left by the one before it. """
+        try:
+            self.build_fixtures()
+            self.start_server()
+            self.measure("cold_install")
+            self.measure("warm_start")
+            self.publish_app_version([0, 2, 0])
+            self.measure("app_upgrade")
+            self.measure("staged_switch")
+            self.publish_launcher_version()
+            self.measure("launcher_update")
+            self.measure_lan_cache_install()
+        finally:
+            if self.cache_server is not None:
+                self.cache_server.terminate()
+                self.cache_server.wait()
+            if self.server is not None:
+                self.server.shutdown()
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+        return self.results
+
+    def build_fixtures(self):
+        """ Creates the fake app repository, the published launcher files and an empty node with the launcher installed """
+        os.makedirs(self.app_work_tree + "/requirements")
+        os.makedirs(self.app_work_tree + "/interface")
+        with open(self.app_work_tree + "/" + APP_NAME + ".py", "w") as file:
+            file.write(APP_ENTRY_POINT)
+        open(self.app_work_tree + "/__init__.py", "w").close()
+        with open(self.app_work_tree + "/requirements/requirements.txt", "w") as file:
+            file.write("# The stand-in app has no third-party requirements\n")
+        with open(self.app_work_tree + "/interface/config.txt", "w") as file:
+            json.dump({"app_name": APP_NAME}, file)
+        self.git("init", "-q", "-b", "stable", self.app_work_tree)
+        os.makedirs(self.remote_dir)
+        self.publish_app_version(self.app_version, initial=True)
+        self.git("clone", "-q", "--bare", self.app_work_tree, self.remote_dir + "/" + APP_NAME + ".git")
+        with open(self.www_dir + f"/repos/{ORGANISATION}/{APP_NAME}/releases/latest", "w") as file:
+            json.dump({"tag_name": "v0.1.0"}, file)
+        self.install_launcher(self.node_dir)
+        with open(self.source_dir + "/VERSION.txt") as file:
+            self.launcher_version = json.load(file)
+        self.publish_launcher_files()
+
+    def publish_app_version(self, version, initial=False, requirements=None):
+        """ Commits a new version of the fake app and publishes its VERSION.txt """
+        self.app_version = version
+        if requirements is not None:
+            with open(self.app_work_tree + "/requirements/requirements.txt", "w") as file:
+                file.write("".join(requirement + "\n" for requirement in requirements))
+        version_file = json.dumps({"MAJOR": str(version[0]), "MINOR": str(version[1]), "PATCH": str(version[2])})
+        with open(self.app_work_tree + "/VERSION.txt", "w") as file:
+            file.write(version_file)
+        self.git("-C", self.app_work_tree, "add", "-A")
+        self.git("-C", self.app_work_tree, "-c", "user.name=benchmark", "-c", "user.email=benchmark@localhost", "commit", "-q", "-m", f"Version {version}")
+        if not initial:
+            self.git("-C", self.app_work_tree, "push", "-q", self.remote_dir + "/" + APP_NAME + ".git", "stable")
+        raw_dir = self.www_dir + "/" + APP_NAME + "/stable"
+        os.makedirs(raw_dir, exist_ok=True)
+        os.makedirs(self.www_dir + f"/repos/{ORGANISATION}/{APP_NAME}/releases", exist_ok=True)
+        with open(raw_dir + "/VERSION.txt", "w") as file:
+            file.write(version_file)
+
+    def publish_launcher_files(self):
+        """ Publishes the launcher files and their manifest under the raw host, as the stable branch of ClaverLauncher would """
+        raw_dir = self.www_dir + "/ClaverLauncher/stable"
+        os.makedirs(raw_dir, exist_ok=True)
+        for name in LAUNCHER_FILES:
+            shutil.copy(self.source_dir + "/" + name, raw_dir + "/" + name)
+        with open(raw_dir + "/VERSION.txt", "w") as file:
+            json.dump(self.launcher_version, file)
+        write_manifest(raw_dir)
+
+    def publish_launcher_version(self):
+        """ Publishes the same launcher code under a higher patch number so that nodes update themselves """
+        self.launcher_version["PATCH"] = str(int(self.launcher_version["PATCH"]) + 1)
+        self.publish_launcher_files()
+
+    def install_launcher(self, node_dir):
+        """ Copies the launcher being measured into an empty node directory """
+        os.makedirs(node_dir)
+        for name in LAUNCHER_FILES:
+            shutil.copy(self.source_dir + "/" + name, node_dir + "/" + name)
+
+    def start_server(self):
+        """ Serves www_dir on a free local port in a background thread """
+        handler = functools.partial(QuietHandler, directory=self.www_dir)
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def get_environment(self):
+        """ Environment that points the launcher at the local stand-ins for the public hosts """
+        base_url = f"http://127.0.0.1:{self.server.server_address[1]}/"
+        env = dict(os.environ)
+        env.update({
+            "CLAVER_REPOSITORY_HOST_URL": "file://" + self.remote_dir + "/",
+            "CLAVER_REPOSITORY_RAW_HOST_URL": base_url,
+            "CLAVER_REPOSITORY_API_URL": base_url + f"repos/{ORGANISATION}/",
+        })
+        if self.find_links:
+            env.update({"PIP_NO_INDEX": "1", "PIP_FIND_LINKS": os.path.abspath(self.find_links)})
+        return env
+
+    def start_cache_server(self):
+        """ Installs a second launcher instance and runs its cache server on a free local port. Returns the URL nodes use to reach it. """
+        self.install_launcher(self.cache_node_dir)
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            port = probe.getsockname()[1]
+        self.cache_server = subprocess.Popen([sys.executable, "cache_server.py", "--port", str(port)], cwd=self.cache_node_dir, env=self.get_environment(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                return f"http://127.0.0.1:{port}/"
+            except OSError:
+                time.sleep(0.1)
+        raise RuntimeError("cache_server.py did not start")
+
+    def measure_lan_cache_install(self):
+        """ Publishes a version of the app with a requirement and installs it on a new node that can only reach the LAN cache.
+            Fails if any file or wheel had to come from anywhere else. """
+        self.publish_app_version([0, 3, 0], requirements=["six"])
+        lan_cache_url = self.start_cache_server()
+        # The first request for a release builds its bundle and wheels, which can outlast a node's request timeout. Measure a cache that has already done so.
+        urllib.request.urlopen(lan_cache_url + f"bundles/{APP_NAME}/stable.json", timeout=600).read()
+        self.install_launcher(self.lan_node_dir)
+        unreachable = "http://127.0.0.1:9/"     # Nothing listens on the discard port
+        report = self.measure("lan_cache_install", node_dir=self.lan_node_dir, env={
+            "CLAVER_LAN_CACHE_URL": lan_cache_url,
+            "CLAVER_REPOSITORY_HOST_URL": "file://" + self.work_dir + "/unreachable/",
+            "CLAVER_REPOSITORY_RAW_HOST_URL": unreachable,
+            "CLAVER_REPOSITORY_API_URL": unreachable,
+        })
+        fallbacks = [event["name"] for event in report["events"] if event["kind"] == "subprocess" and (" wheel " in event["name"] and "--no-index" not in event["name"] or " clone " in event["name"])]
+        if fallbacks:
+            raise RuntimeError(f"lan_cache_install: the LAN cache did not serve everything. Fell back to: {fallbacks}")
+        if not glob.glob(self.lan_node_dir + "/cache/wheelhouse/six-*.whl"):
+            raise RuntimeError("lan_cache_install: the requirements of the app were not taken from the LAN wheelhouse")
+
+    def measure(self, scenario, node_dir=None, env=None):
+        """ Runs init.py once on a node (by default the main one) and records wall time, subprocess count and bytes written. Returns the timing report. """
+        node_dir = node_dir or self.node_dir
+        environment = self.get_environment()
+        environment.update(env or {})
+        size_before = self.get_directory_size(node_dir)
+        start_time = time.monotonic()
+        launcher = subprocess.run([sys.executable, "init.py"], cwd=node_dir, env=environment, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        wall_time = time.monotonic() - start_time
+        if launcher.returncode:
+            print(launcher.stdout)
+            raise RuntimeError(f"{scenario}: init.py exited with status {launcher.returncode}")
+        report = self.load_timing_report(node_dir)
+        launch = [event["start"] for event in report["events"] if event["name"] == "run_client_app"]
+        self.results.append({
+            "scenario": scenario,
+            "wall_time": round(wall_time, 3),
+            "time_to_launch": launch[-1] if launch else None,   # Seconds from start to the app entry point, as seen by the launcher
+            "subprocesses": report["summary"].get("subprocess", {}).get("count", 0),
+            "http_requests": report["summary"].get("http", {}).get("count", 0),
+            "execs": report["execs"],
+            "bytes_written": self.get_directory_size(node_dir) - size_before,  # Net growth of the node directory
+        })
+        return report
+
+    def load_timing_report(self, node_dir=None):
+        """ Returns the newest timing report written by the launcher """
+        reports = glob.glob((node_dir or self.node_dir) + "/logs/startup-*.json")
+        with open(max(reports, key=os.path.getmtime)) as file:
+            return json.load(file)
+
+    def get_directory_size(self, path) -> int:
+        """ Returns the combined size in bytes of every file below path. Hardlinked files are counted once. """
+        size = 0
+        seen = set()
+        for root, dirs, files in os.walk(path):
+            for name in files:
+                status = os.lstat(os.path.join(root, name))
+                if not os.path.islink(os.path.join(root, name)) and (status.st_dev, status.st_ino) not in seen:
+                    seen.add((status.st_dev, status.st_ino))
+                    size += status.st_size
+        return size
+
+    def git(self, *args):
+        subprocess.run(["git"] + list(args), check=True)
+
+
+def print_results(results):
+    columns = ["scenario", "wall_time", "time_to_launch", "subprocesses", "http_requests", "execs", "bytes_written"]
+    print("  ".join(f"{column:>17}" for column in columns))
+    for result in results:
+        print("  ".join(f"{str(result[column]):>17}" for column in columns))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cold/warm start benchmark for the Claver launcher using local stand-in repositories")
+    parser.add_argument("--find-links", help="Directory of wheels used instead of the package index for venv installs")
+    parser.add_argument("--json", help="Also write the results to this file as JSON")
+    arguments = parser.parse_args()
+    results = Benchmark(find_links=arguments.find_links).run()
+    print_results(results)
+    if arguments.json:
+        with open(arguments.json, "w") as file:
+            json.dump(results, file, indent=2)
@@ -0,0 +1,190 @@
+import argparse
+import functools
+import hashlib
+import http.server
+import json
+import logging
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from fetcher import Fetcher
+from log_pipeline import LogPipeline
+
+"""
+Cache server mode of the launcher. One node on a site runs:
+    python cache_server.py [--port 8700]
+and every other node sets "lan_cache_url": "http://<that node>:8700/" in config.txt. Those nodes try the cache before GitHub.
+The cache fetches from the public hosts at most once per refresh interval, however many nodes ask, and serves:
+    /raw/<path>                         - raw.githubusercontent.com files (VERSION.txt, MANIFEST.json, launcher files)
+    /api/<path>                         - api.github.com documents (latest release)
+    /bundles/<repo>/<branch>.json       - commit, version and SHA-256 of the newest app bundle on a branch
+    /bundles/<repo>/<repo>-<commit>.tar.gz
+    /wheels/                            - wheels for the requirements of every bundle. Nodes must share the server's platform and Python version.
+"""
+
+NAME = re.compile(r"^[A-Za-z0-9._-]+$")   # Repository and branch names accepted in bundle paths
+LAUNCHER_REQUIREMENTS = ["requests", "psutil"]  # Installed into every venv next to the app requirements (Init.required_modules)
+
+
+class CacheRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """ Maps each request onto a file in the cache directory and lets SimpleHTTPRequestHandler serve it, including If-Modified-Since """
+    def do_GET(self):
+        if self.map_path():
+            super().do_GET()
+
+    def do_HEAD(self):
+        if self.map_path():
+            super().do_HEAD()   # Headers only
+
+    def map_path(self) -> bool:
+        """ Points self.path at the cache file that answers the request. Sends a 404 and returns False if there is none. """
+        path = self.resolve(self.path.split("?")[0])
+        if path is None:
+            self.send_error(404)
+            return False
+        self.path = "/" + path
+        return True
+
+    def resolve(self, path):
+        """ Returns the cache-relative path of the file that answers a request, or None """
+        cache = self.server.cache
+        if path.startswith("/raw/"):
+            return cache.get_upstream_file(cache.repository_raw_host_url + path[len("/raw/"):])
+        if path.startswith("/api/"):
+            return cache.get_upstream_file(cache.repository_api_url + path[len("/api/"):])
+        parts = path.strip("/").split("/")
+        if len(parts) == 3 and parts[0] == "bundles" and parts[2].endswith(".json"):
+            return cache.get_bundle_index(parts[1], parts[2][:-len(".json")])
+        if parts[0] in ("bundles", "wheels") and ".." not in parts:   # Bundles and wheels are immutable once written
+            return "/".join(parts) + ("/" if path.endswith("/") else "")    # A directory listing without its slash is redirected back to the slash
+        return None
+
+    def log_message(self, format, *args):
+        self.server.cache.logger.debug(f"{self.address_string()} {format % args}")
+
+
+class CacheServer:
+    def __init__(self, port=8700, cache_dir="cache/lan", refresh_interval=60):
+        self.port = port
+        self.cache_dir = cache_dir      # Everything the server hands out lives below this directory
+        self.refresh_interval = refresh_interval    # Seconds an upstream copy is served before the public host is asked again
+        self.repository_host_url = os.environ.get("CLAVER_REPOSITORY_HOST_URL", "https://github.com/mccolm-robotics/")
+        self.repository_raw_host_url = os.environ.get("CLAVER_REPOSITORY_RAW_HOST_URL", "https://raw.githubusercontent.com/mccolm-robotics/")
+        self.repository_api_url = os.environ.get("CLAVER_REPOSITORY_API_URL", "https://api.github.com/repos/mccolm-robotics/")
+        self.request_timeout = 30   # Seconds to wait on any single upstream request
+        self.wheelhouse = cache_dir + "/wheels"
+        self.refreshed = {}     # Time of the last upstream check for each URL or bundle
+        self.locks = {}     # One lock per URL or bundle. Nodes asking for the same thing wait for a single upstream request.
+        self.lock = threading.Lock()
+        self.setup_logging()
+        self.fetcher = Fetcher(cache_dir=cache_dir, timeout=self.request_timeout, logger=self.logger)
+
+    def serve_forever(self):
+        os.makedirs(self.wheelhouse, exist_ok=True)
+        handler = functools.partial(CacheRequestHandler, directory=self.cache_dir)
+        server = http.server.ThreadingHTTPServer(("", self.port), handler)
+        server.cache = self
+        self.logger.info(f"Serving launcher cache from {self.cache_dir} on port {self.port}")
+        server.serve_forever()
+
+    def get_lock(self, key):
+        with self.lock:
+            return self.locks.setdefault(key, threading.Lock())
+
+    def is_due(self, key) -> bool:
+        """ True if key has not been checked upstream within the refresh interval. Records the check. """
+        now = time.monotonic()
+        if key in self.refreshed and now - self.refreshed[key] < self.refresh_interval:
+            return False
+        self.refreshed[key] = now
+        return True
+
+    def get_upstream_file(self, url):
+        """ Returns the cached copy of url, revalidating it upstream once per refresh interval. A stale copy is served if the public host is unreachable. """
+        file_name = "raw/" + hashlib.sha256(url.encode()).hexdigest()[:16]
+        with self.get_lock(url):
+            if self.is_due(url) and not self.fetcher.save_remote_file(url, self.cache_dir + "/" + file_name):
+                self.logger.warning(f"Unable to refresh {url}")
+        return file_name if os.path.isfile(self.cache_dir + "/" + file_name) else None
+
+    def get_bundle_index(self, repo_name, branch):
+        """ Returns the index of the newest bundle of a branch, building the bundle and its wheels when the branch has moved """
+        if not NAME.match(repo_name) or not NAME.match(branch):
+            return None
+        index_file = f"bundles/{repo_name}/{branch}.json"
+        with self.get_lock(index_file):
+            if self.is_due(index_file):
+                self.build_bundle(repo_name, branch, index_file)
+        return index_file if os.path.isfile(self.cache_dir + "/" + index_file) else None
+
+    def build_bundle(self, repo_name, branch, index_file) -> bool:
+        """ Fetches the branch into a local mirror and archives its head commit as <repo>-<commit>.tar.gz """
+        mirror = self.cache_dir + "/git/" + repo_name + ".git"
+        repo_url = self.repository_host_url + repo_name + ".git"
+        if not os.path.isdir(mirror):
+            os.makedirs(os.path.dirname(mirror), exist_ok=True)
+            if self.git(["clone", "--bare", repo_url, mirror]) is None:
+                return False
+        if self.git(["--git-dir", mirror, "fetch", "--prune", repo_url, f"+refs/heads/{branch}:refs/heads/{branch}"]) is None:
+            return False
+        commit = self.git(["--git-dir", mirror, "rev-parse", f"refs/heads/{branch}"])
+        if commit is None:
+            return False
+        commit = commit.strip()
+        bundle = f"bundles/{repo_name}/{repo_name}-{commit}.tar.gz"
+        if not os.path.isfile(self.cache_dir + "/" + bundle):
+            os.makedirs(os.path.dirname(self.cache_dir + "/" + bundle), exist_ok=True)
+            if self.git(["--git-dir", mirror, "archive", "--format=tar.gz", "-o", self.cache_dir + "/" + bundle + ".tmp", commit]) is None:
+                return False
+            os.replace(self.cache_dir + "/" + bundle + ".tmp", self.cache_dir + "/" + bundle)
+            self.logger.info(f"Built {bundle}")
+            self.build_wheels(mirror, commit)
+        version = self.git(["--git-dir", mirror, "show", f"{commit}:VERSION.txt"])
+        index = {
+            "commit": commit,
+            "version": json.loads(version) if version else None,
+            "file": bundle,
+            "sha256": self.fetcher.hash_file(self.cache_dir + "/" + bundle),
+        }
+        with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(self.cache_dir + "/" + index_file), delete=False) as file:
+            json.dump(index, file, indent=2, sort_keys=True)
+        os.replace(file.name, self.cache_dir + "/" + index_file)
+        return True
+
+    def build_wheels(self, mirror, commit):
+        """ Adds wheels for the requirements of a commit, and for the launcher's own, to the wheelhouse. Nodes fall back to the package index if this fails. """
+        requirements = self.git(["--git-dir", mirror, "show", f"{commit}:requirements/requirements.txt"])
+        if requirements is None:
+            return
+        with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as file:
+            file.write(requirements)
+        try:
+            build_wheels = subprocess.run([sys.executable, "-m", "pip", "wheel", "--prefer-binary", "--find-links", self.wheelhouse, "--wheel-dir", self.wheelhouse, "-r", file.name] + LAUNCHER_REQUIREMENTS, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+            if build_wheels.returncode:
+                self.logger.warning(f"Unable to build wheels for {commit}: {build_wheels.stdout}")
+        finally:
+            os.remove(file.name)
+
+    def git(self, args):
+        """ Runs git and returns its output, or None on failure """
+        result = subprocess.run(["git"] + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        if result.returncode:
+            self.logger.error(f"Error: git {' '.join(args)} failed: {result.stderr.strip()}")
+            return None
+        return result.stdout
+
+    def setup_logging(self):
+        """ Logs to the console and to logs/cache_server.log through the launcher's log pipeline """
+        LogPipeline.setup("cache_server", console=logging.INFO, file=logging.WARNING)
+        self.logger = logging.getLogger(__name__)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve Claver launcher and app updates to the other nodes on the local network")
+    parser.add_argument("--port", type=int, default=8700)
+    parser.add_argument("--refresh-interval", type=int, default=60, help="Seconds between checks of the public hosts")
+    arguments = parser.parse_args()
+    CacheServer(port=arguments.port, refresh_interval=arguments.refresh_interval).serve_forever()
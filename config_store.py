@@ -0,0 +1,72 @@
+import copy
+import json
+import os
+import tempfile
+import threading
+
+
+class ConfigStore(dict):
+    """ The contents of config.txt. Used as a plain dictionary. save() writes only when the contents differ from the copy on disk, and replaces the file atomically.
+        Every change and every save holds lock. Changes that span several keys, or edit a nested value, are made under "with store.lock:" so a save sees all or none of them. """
+    def __init__(self, data=None, path="config.txt"):
+        super().__init__(data or {})
+        self.path = path    # File the store is saved to
+        self.saved = {}     # Contents of path as last read or written
+        self.lock = threading.RLock()   # The launcher changes and saves the store from the staging, health check and request threads as well as the main thread
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        with self.lock:
+            super().__delitem__(key)
+
+    def pop(self, *args):
+        with self.lock:
+            return super().pop(*args)
+
+    def setdefault(self, key, default=None):
+        with self.lock:
+            return super().setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        with self.lock:
+            super().update(*args, **kwargs)
+
+    @classmethod
+    def load(cls, source, path="config.txt"):
+        """ Reads a JSON file into a store that saves to path. Only a store read from path itself starts out clean. """
+        with open(source) as file:
+            store = cls(json.load(file), path=path)
+        if os.path.abspath(source) == os.path.abspath(path):
+            store.saved = copy.deepcopy(dict(store))
+        return store
+
+    def dirty_keys(self) -> list:
+        """ Keys added, changed or removed since the last read or write, including changes made inside nested values """
+        with self.lock:
+            return sorted(key for key in set(self) | set(self.saved) if key not in self or key not in self.saved or self[key] != self.saved[key])
+
+    def save(self) -> bool:
+        """ Writes the store if anything changed. Returns True if the file was written. """
+        with self.lock:
+            contents = copy.deepcopy(dict(self))
+            if contents == self.saved and os.path.isfile(self.path):
+                return False
+            directory = os.path.dirname(os.path.abspath(self.path))
+            with tempfile.NamedTemporaryFile("w", dir=directory, prefix=".config-", delete=False) as file:
+                json.dump(contents, file, indent=2, sort_keys=True)
+                file.flush()
+                os.fsync(file.fileno())     # The data must be on the card before the rename makes it visible
+            os.replace(file.name, self.path)    # A power loss leaves either the old or the new config.txt, never a partial one
+            try:
+                descriptor = os.open(directory, os.O_RDONLY)
+                try:
+                    os.fsync(descriptor)    # Makes the rename itself durable
+                finally:
+                    os.close(descriptor)
+            except OSError:
+                pass
+            self.saved = contents
+            return True
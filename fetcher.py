@@ -0,0 +1,130 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+
+class Fetcher:
+    """ HTTP client shared by the launcher and the updater. Reuses connections, revalidates cached files with ETag/Last-Modified and streams bodies to disk. """
+    def __init__(self, cache_dir="cache", timeout=5, logger=None, tracer=None):
+        self.cache_dir = cache_dir      # Directory holding the validator index and cached response bodies
+        self.timeout = timeout      # Seconds to wait on any single request
+        self.logger = logger or logging.getLogger(__name__)
+        self.tracer = tracer    # Optional StartupTracer that records the timing of every request
+        self.validators_file = cache_dir + "/http_cache.json"   # Maps each URL to the ETag/Last-Modified of the copy saved on disk
+        self.validators = {}
+        self.lock = threading.Lock()    # Requests may be issued from several threads at once
+        self.session = None     # Created on first use so that this module can be imported before requests is installed
+        self.mirrors = []   # (prefix, mirror prefix) pairs. A URL under prefix is requested from the mirror first (e.g. a LAN cache_server.py).
+        if os.path.isfile(self.validators_file):
+            try:
+                with open(self.validators_file) as file:
+                    self.validators = json.load(file)
+            except ValueError:
+                self.logger.warning("Discarding unreadable HTTP cache index")
+
+    def get_session(self):
+        """ Returns the session used for every request. Keeps TLS connections open between requests to the same host. """
+        with self.lock:
+            if self.session is None:
+                import requests
+                self.session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=8)
+                self.session.mount("https://", adapter)
+                self.session.mount("http://", adapter)
+            return self.session
+
+    def add_mirror(self, prefix, mirror_prefix):
+        """ Requests URLs starting with prefix from mirror_prefix first. The original URL is used if the mirror fails. """
+        self.mirrors.append((prefix, mirror_prefix))
+
+    def save_remote_file(self, url, file_name) -> bool:
+        """ Saves the resource at url to file_name. Returns True when file_name holds the current copy, whether or not it was downloaded. """
+        for prefix, mirror_prefix in self.mirrors:
+            if url.startswith(prefix) and self.download(mirror_prefix + url[len(prefix):], file_name):
+                return True
+        return self.download(url, file_name)
+
+    def download(self, url, file_name) -> bool:
+        """ Fetches url into file_name unless the server confirms the copy on disk is current """
+        import requests
+        headers = {}
+        cached = self.validators.get(url)
+        if cached and cached["file"] == file_name and cached["sha256"] == self.hash_file(file_name):    # Only revalidate a copy that is still intact on disk
+            if cached.get("etag"):
+                headers["If-None-Match"] = cached["etag"]
+            if cached.get("last_modified"):
+                headers["If-Modified-Since"] = cached["last_modified"]
+        started = time.time()
+        clock = time.monotonic()
+        status = None
+        received = 0
+        try:
+            with self.get_session().get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+                status = response.status_code
+                if response.status_code == 304:     # The copy on disk is current
+                    return True
+                if response.status_code >= 400:
+                    return False
+                directory = os.path.dirname(file_name) or "."
+                os.makedirs(directory, exist_ok=True)
+                digest = hashlib.sha256()
+                # Write into the destination directory so the final rename cannot cross file systems
+                with tempfile.NamedTemporaryFile(dir=directory, prefix=".download-", delete=False) as file:
+                    try:
+                        for chunk in response.iter_content(chunk_size=65536):
+                            file.write(chunk)
+                            digest.update(chunk)
+                            received += len(chunk)
+                    except BaseException:
+                        file.close()
+                        os.remove(file.name)
+                        raise
+                os.replace(file.name, file_name)    # Atomic. Readers see either the old file or the complete new one.
+                self.save_validators(url, {
+                    "file": file_name,
+                    "sha256": digest.hexdigest(),
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                })
+                return True
+        except (requests.RequestException, OSError):
+            self.logger.warning(f"Unable to download {url}", exc_info=True)
+            return False
+        finally:
+            if self.tracer is not None:
+                self.tracer.record("http", url, started, time.monotonic() - clock, status=status, bytes=received)
+
+    def load_json(self, url):
+        """ Downloads a JSON document and returns its contents. Unchanged documents are read from the local cache after a 304 response. Returns False on failure. """
+        file_name = self.cache_dir + "/http/" + hashlib.sha256(url.encode()).hexdigest()[:16] + ".json"
+        if not self.save_remote_file(url, file_name):
+            return False
+        try:
+            with open(file_name) as file:
+                return json.load(file)
+        except ValueError:
+            self.logger.warning(f"Invalid JSON received from {url}")
+            return False
+
+    def save_validators(self, url, entry):
+        """ Records the validators of a downloaded file and writes the index to disk """
+        with self.lock:
+            self.validators[url] = entry
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with tempfile.NamedTemporaryFile("w", dir=self.cache_dir, prefix=".http_cache-", delete=False) as file:
+                json.dump(self.validators, file, indent=2, sort_keys=True)
+            os.replace(file.name, self.validators_file)
+
+    def hash_file(self, file_name):
+        """ Returns the SHA-256 digest of a file, or None if it does not exist """
+        if not os.path.isfile(file_name):
+            return None
+        digest = hashlib.sha256()
+        with open(file_name, "rb") as file:
+            for chunk in iter(lambda: file.read(65536), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
@@ -1,28 +1,85 @@
+import hashlib
 import importlib
 import json
 import logging
 import os
+import re
+import shutil
 import subprocess
 import sys
+import sysconfig
+import tarfile
+import threading
 import time
+from config_store import ConfigStore
+from fetcher import Fetcher
+from log_pipeline import LogPipeline
+from tracer import StartupTracer
+from version_store import VersionStore
 
 """
 NOTE:
 Target system must have python > 3.6 installed
 Target system must have pip3 installed and a symlink pointing to pip
 Target system must have virtualenv installed
-Target system must have curl installed
+"""
+
+ACTION_EXIT_BASE = 64   # A supervised app process exits with ACTION_EXIT_BASE + action_request. Any other status is a crash.
+ACTION_REQUESTS = (0, 1, 2)     # No further action, upgrade, development mode. Statuses such as 70 (EX_SOFTWARE) are crashes, not action 6.
+BASE_DISTRIBUTIONS = ["pip", "setuptools", "wheel"]     # Installed by virtualenv into every venv. Never pruned.
+# Run by the venv interpreter. Prints the distributions that are neither a base distribution nor needed, directly or indirectly, by the requirements given as arguments.
+UNNEEDED_DISTRIBUTIONS_SCRIPT = """
+import sys
+from importlib import metadata
+from pip._vendor.packaging.requirements import Requirement
+from pip._vendor.packaging.utils import canonicalize_name
+needed = set()
+pending = [Requirement(line) for line in sys.argv[1:]]
+while pending:
+    requirement = pending.pop()
+    if canonicalize_name(requirement.name) in needed:
+        continue
+    needed.add(canonicalize_name(requirement.name))
+    try:
+        dependencies = metadata.distribution(requirement.name).requires or []
+    except metadata.PackageNotFoundError:
+        continue
+    for dependency in map(Requirement, dependencies):
+        if dependency.marker is None or any(dependency.marker.evaluate({"extra": extra}) for extra in requirement.extras or [""]):
+            pending.append(dependency)
+for distribution in metadata.distributions():
+    if canonicalize_name(distribution.metadata["Name"]) not in needed:
+        print(distribution.metadata["Name"])
 """
 
 class Init:
     def __init__(self):
+        self.tracer = StartupTracer()   # Times every phase, subprocess and request of this start. Written to logs/startup-*.json
         self.config = None      # A dictionary representation of JSON data describing the app
         self.application = None     # Holds an instance of the entry_point class for the application loaded from the github repository linked below
         self.clock = int(time.time())   # Unix timestamp used as a name for the cloned git repository
-        self.venv_interpreter = os.getcwd() + "/venv/bin/python"    # Path to the virtual environment Python interpreter
-        self.required_modules = ["requests"]  # List of 3rd party modules required by the Claver launcher
-        self.repository_host_url = "https://github.com/mccolm-robotics/"
-        self.repository_raw_host_url = "https://raw.githubusercontent.com/mccolm-robotics/"
+        self.venv_pool = "venvs"    # One venv per distinct requirements file, named by its hash. Versions that share requirements share a venv.
+        self.venv_dir = None    # Pool venv of the active version of the app. Set by select_venv().
+        self.venv_interpreter = None    # Path to the virtual environment Python interpreter
+        self.required_modules = ["requests", "psutil"]  # List of 3rd party modules required by the Claver launcher
+        self.pip = None    # Runs the venv copy of pip from either interpreter
+        self.exec_count = int(os.environ.pop("CLAVER_EXEC_COUNT", 0))  # Number of times the launcher has re-exec'd itself during this start
+        self.bootstrapped = os.environ.pop("CLAVER_BOOTSTRAPPED", None) is not None   # Set by restart_launcher() once the bootstrap plan has been carried out
+        self.late_remote_checks = [key for key in os.environ.pop("CLAVER_LATE_CHECKS", "").split(",") if key]  # Remote checks that missed the deadline before the last re-exec
+        self.venv_fingerprint_file = None    # Snapshot of the venv site-packages taken after the last dependency check
+        # Hosts can be pointed elsewhere (e.g. at the local stand-ins used by benchmark.py) through the environment
+        self.repository_host_url = os.environ.get("CLAVER_REPOSITORY_HOST_URL", "https://github.com/mccolm-robotics/")
+        self.repository_raw_host_url = os.environ.get("CLAVER_REPOSITORY_RAW_HOST_URL", "https://raw.githubusercontent.com/mccolm-robotics/")
+        self.repository_api_url = os.environ.get("CLAVER_REPOSITORY_API_URL", "https://api.github.com/repos/mccolm-robotics/")
+        self.lan_cache_url = os.environ.get("CLAVER_LAN_CACHE_URL")  # Base URL of a node running cache_server.py. Tried before the public hosts.
+        self.request_timeout = 5    # Seconds to wait on any single remote request before giving up on it
+        self.remote_versions = {}   # Remote version data gathered by resolve_remote_versions(), keyed by module
+        self.update_check_budget = 10   # Seconds an installed app will wait on remote version checks before launching offline
+        self.supervisor_mode = False    # When True the launcher stays resident and runs the app in a child process
+        self.supervisor_max_backoff = 60    # Longest wait in seconds between restarts of a crashing app
+        self.health_check_timeout = 30  # Seconds a newly promoted version must keep running (or report a status) before it is trusted
+        self.health_timer = None    # Marks a candidate version healthy once it has run for health_check_timeout seconds
+        self.rolled_back = False    # Set when a candidate version failed its health check and the previous version was restored
         self.client_app_repo_branch = "stable"   # Default branch of the git repository to load
         self.client_app_repo_name = "ClaverMessageBoard" # Name of the git repository to load
         self.client_app_repo_class_name = self.client_app_repo_name   # Name of the entry_point class for the application
@@ -30,136 +87,348 @@ class Init:
         self.launcher_repo_branch = "stable"
         self.launcher_repo_name = "ClaverLauncher"
         self.launcher_repo_url = self.repository_host_url + self.launcher_repo_name + ".git"
+        self.cache_dir = "cache"    # Persistent data kept between runs of the launcher
+        self.client_app_mirror = self.cache_dir + "/" + self.client_app_repo_name + ".git"    # Bare copy of the app repository. New versions are checked out from it.
+        self.wheelhouse = self.cache_dir + "/wheelhouse"    # Wheels built or downloaded for the app requirements
+        self.fetcher = None     # Shared HTTP client. Created once logging is available.
+        self.staging_thread = None  # Background thread preparing the next version of the app while the current one runs
+        self.upgrade_lock = threading.Lock()    # Keeps staging, foreground upgrades and version collection from working on t<clock> directories at the same time
+        self.version_store = None   # Manages the t<clock> directories (version_store.py)
+        self.collection_thread = None   # Background thread removing and deduplicating old versions of the app
+        self.retained_versions = 2  # Installed versions kept on disk, counting the active one
         self.action_request = None    # Exit status for the client app run by the launcher
+        self.log_total_bytes = 20 * 1024 * 1024     # Cap on the size of everything kept in logs/
         if os.path.isfile("config.txt"):    # Check to see if config file already exists
             self.load_config_file("config.txt")     # Read in file (JSON)
             self.client_app_repo_name = self.config["app_dir"]   # Set the repository name to value stored in config file
+            self.select_venv(self.client_app_repo_name)
+            if "update_check_budget" in self.config:
+                self.update_check_budget = self.config["update_check_budget"]
+            if "supervisor_mode" in self.config:
+                self.supervisor_mode = self.config["supervisor_mode"]
+            if "supervisor_max_backoff" in self.config:
+                self.supervisor_max_backoff = self.config["supervisor_max_backoff"]
+            if "health_check_timeout" in self.config:
+                self.health_check_timeout = self.config["health_check_timeout"]
+            if "lan_cache_url" in self.config:
+                self.lan_cache_url = self.config["lan_cache_url"]
+            if "retained_versions" in self.config:
+                self.retained_versions = self.config["retained_versions"]
+            if "log_total_bytes" in self.config:
+                self.log_total_bytes = self.config["log_total_bytes"]
             if "dev_branch" in self.config:
                 self.client_app_repo_branch = self.config["dev_branch"]
                 self.launcher_repo_branch = self.config["dev_branch"]
         self.setup_logging(console=logging.DEBUG, file=logging.INFO)    # Set the logging level for launcher. DEBUG == verbose
-        self.install_launcher_dependencies(["psutil", "requests"])
+        self.fetcher = Fetcher(cache_dir=self.cache_dir, timeout=self.request_timeout, logger=self.logger, tracer=self.tracer)
+        self.version_store = VersionStore(retained_versions=self.retained_versions, logger=self.logger, tracer=self.tracer)
+        if self.lan_cache_url:
+            self.lan_cache_url = self.lan_cache_url.rstrip("/") + "/"
+            self.fetcher.add_mirror(self.repository_raw_host_url, self.lan_cache_url + "raw/")
+            self.fetcher.add_mirror(self.repository_api_url, self.lan_cache_url + "api/")
+        if sys.executable != self.venv_interpreter:     # Once running in the venv these modules come from required_modules
+            self.install_launcher_dependencies(["psutil", "requests"])
         self.run_launcher()
 
     def install_launcher_dependencies(self, dependency_list: list):
         """ Install launcher dependencies """
         for dep in dependency_list:
-            module_check = subprocess.run(["pip", "show", dep], capture_output=True, encoding="utf-8")
-            if not module_check.stdout:
+            if not self.is_module_installed(dep):
                 self.logger.info(f"Installing {dep}")
-                module_install = subprocess.run(["pip", "install", "--user", dep], stdout=subprocess.PIPE, text=True, check=True)
+                module_install = self.tracer.run(["pip", "install", "--user", dep], stdout=subprocess.PIPE, text=True, check=True)
                 if module_install.returncode:
                     self.logger.error(f"Error: Unable to install {dep} module")
 
+    def is_module_installed(self, module) -> bool:
+        """ Looks up the distribution in the metadata of the running interpreter instead of spawning pip """
+        try:
+            from importlib import metadata
+        except ImportError:     # importlib.metadata requires Python 3.8. Fall back to asking pip.
+            module_check = self.tracer.run(["pip", "show", module], capture_output=True, encoding="utf-8")
+            return bool(module_check.stdout)
+        try:
+            metadata.version(module)
+        except metadata.PackageNotFoundError:
+            return False
+        return True
+
+    def get_venv_site_packages(self, venv_dir=None):
+        """ Returns the site-packages directory of a venv (default the active one). Works from the system interpreter as well as the venv interpreter. """
+        venv_dir = venv_dir or self.venv_dir
+        if os.path.abspath(sys.prefix) == os.path.abspath(venv_dir):
+            return sysconfig.get_paths()["purelib"]
+        return f"{venv_dir}/lib/python{sys.version_info[0]}.{sys.version_info[1]}/site-packages"     # Pool venvs are built for the running Python version
+
+    def get_venv_python_version(self, venv_dir):
+        """ Returns the major.minor version of the Python a venv was built for, as recorded in its pyvenv.cfg, or None """
+        if not os.path.isfile(venv_dir + "/pyvenv.cfg"):
+            return None
+        with open(venv_dir + "/pyvenv.cfg") as file:
+            settings = dict(line.split("=", 1) for line in file if "=" in line)
+        settings = {key.strip(): value.strip() for key, value in settings.items()}
+        version = settings.get("version_info") or settings.get("version")  # virtualenv writes version_info, the venv module only version
+        return ".".join(version.split(".")[:2]) if version else None
+
+    def get_installed_distributions(self, venv_dir=None) -> list:
+        """ Lists the metadata directories (name and version) of every distribution in the venv site-packages """
+        return sorted(entry for entry in os.listdir(self.get_venv_site_packages(venv_dir)) if entry.endswith((".dist-info", ".egg-info")))
+
+    def get_venv_fingerprint(self):
+        """ Hashes the installed distributions. Any install, removal or version change alters the value. """
+        return hashlib.sha256("\n".join(self.get_installed_distributions()).encode()).hexdigest()
+
     def run_launcher(self):
         ''' Main entry-point for launcher execution '''
-        self.activate_venv()    # Ensures virtual environment is installed and switches over to it.
-        self.check_for_launcher_update()
-        if self.download_client_app():  # Ensures a version of the app has been downloaded and configured to run
-            self.launch_client_app()   # Instantiantes and loads app (based on repo name) and deletes previously installed versions
-        self.evaluate_client_app_action_request()  # Checks for messages sent back from the app
+        if self.bootstrapped:   # Every bootstrap action was carried out before the launcher re-exec'd itself
+            self.logger.info(f"Bootstrap complete after {self.exec_count} re-exec(s)")
+            if self.late_remote_checks:     # Give checks that missed the deadline before the re-exec a chance to finish while the app runs
+                self.resolve_remote_versions(keys=self.late_remote_checks, budget=0)
+        else:
+            with self.tracer.phase("plan_bootstrap"):
+                plan = self.plan_bootstrap()
+            if not self.run_bootstrap_plan(plan):  # Works out and carries out every action needed before launch, re-exec'ing at most once
+                return
+        if self.config is None:
+            self.logger.error("Error: No copy of the app has been installed")
+            return
+        self.config["exec_count"] = self.exec_count
+        with self.tracer.phase("activate_venv"):
+            self.activate_venv()    # Switches path variables over to the virtual environment
+        self.start_background_staging()     # Looks for the next version of the app while this one runs
+        self.start_version_collection()     # Removes old versions of the app while this one runs
+        if self.supervisor_mode:
+            self.supervise_client_app()     # Runs the app in a child process until it exits without asking for a restart
+        else:
+            self.launch_client_app()   # Instantiantes and loads app (based on repo name)
+            with self.tracer.phase("evaluate_action_request"):
+                self.evaluate_client_app_action_request()  # Checks for messages sent back from the app
+        if self.staging_thread is not None:
+            self.staging_thread.join()  # Finish staging so that its result is recorded in config.txt
+        if self.collection_thread is not None:
+            self.collection_thread.join()
         self.save_config_file()    # Saves app config-state to config.txt
+        self.tracer.save()
+
+    def plan_bootstrap(self) -> list:
+        """ Works out every action this start requires before any of them run, so that the launcher re-execs at most once """
+        plan = []
+        budget = self.update_check_budget if self.config is not None else None   # A fresh install has nothing to fall back on and must wait for every request
+        with self.tracer.phase("resolve_remote_versions"):
+            self.late_remote_checks = self.resolve_remote_versions(budget=budget)   # Fetches all remote version data in parallel
+        app_dir = None  # Version of the app that will be launched. Unknown until a fresh install has downloaded it.
+        if self.config is None:
+            plan.append("install_client_app")
+        elif self.config.get("app_state") == "candidate" and self.config.get("candidate_launches", 0) > 0 and os.path.isdir(self.config.get("previous_app_dir", "")):
+            plan.append("rollback_client_app")  # The candidate was launched but the launcher never saw it become healthy (e.g. the node lost power)
+            app_dir = self.config["previous_app_dir"]
+        elif self.get_staged_app_dir():     # A newer version was downloaded and installed in the background during an earlier run
+            plan.append("promote_staged_app")
+            app_dir = self.config["staged_app_dir"]
+        else:
+            app_dir = self.config["app_dir"]
+        if app_dir and not self.is_venv_complete(self.get_venv_dir(app_dir)):  # The version's venv was never built, was interrupted or was deleted
+            plan.append("create_venv")
+        plan.append("check_venv_modules")
+        remote_version, local_version = self.get_launcher_version_numbers()
+        if remote_version and self.check_for_module_update(remote_version=remote_version, local_version=local_version):
+            plan.append("update_launcher")
+        if app_dir is None or sys.executable != self.get_venv_interpreter(app_dir) or "update_launcher" in plan:    # New launcher code and a different venv interpreter both require a fresh process
+            plan.append("restart")
+        return plan
+
+    def run_bootstrap_plan(self, plan) -> bool:
+        """ Carries out the actions chosen by plan_bootstrap(). Ends with a single re-exec when the plan requires one. Returns False if there is nothing that can be launched. """
+        self.logger.info(f"Bootstrap plan: {', '.join(plan)}")
+        if "install_client_app" in plan:
+            with self.tracer.phase("install_client_app"):
+                self.download_client_app()  # Ensures a version of the app has been downloaded and configured to run
+        elif "rollback_client_app" in plan:
+            self.rollback_client_app()
+        elif "promote_staged_app" in plan:
+            self.promote_staged_app()
+        if self.config is None:     # Nothing can be launched without a copy of the app
+            self.logger.error("Error: No copy of the app has been installed")
+            return False
+        if "create_venv" in plan:
+            with self.tracer.phase("create_venv"):
+                venv_ready = self.install_client_app_requirements(self.config["app_dir"])    # Rebuilds the venv of the version in place. The app and config.txt are kept.
+            if not venv_ready:
+                previous_app_dir = self.config.get("previous_app_dir")
+                if self.config.get("app_state") == "candidate" and previous_app_dir and os.path.isdir(previous_app_dir) and self.is_venv_complete(self.get_venv_dir(previous_app_dir)):
+                    self.logger.error(f"Error: Unable to build the venv of {self.config['app_dir']}")
+                    self.rollback_client_app()  # The version it replaced is still installed with its venv
+                else:
+                    self.logger.error(f"Error: Unable to build the venv of {self.config['app_dir']}. Not launching.")
+                    self.save_config_file()
+                    return False
+        with self.tracer.phase("check_venv_modules"):
+            self.ensure_venv_modules()
+        if "update_launcher" in plan:   # Runs after the app install so that the updater records its changes in the app config
+            with self.tracer.phase("update_launcher"):
+                self.update_launcher()
+        if "restart" in plan:
+            self.save_config_file()
+            self.restart_launcher(os.getcwd() + "/init.py")
+        return True
 
     def save_remote_file(self, url, file_name):
-        import requests
-        remote_file = requests.get(url)
-        if remote_file.status_code < 400:
-            with open(file_name, 'wb') as file:
-                file.write(remote_file.content)
+        return self.fetcher.save_remote_file(url, file_name)
 
-    def check_for_launcher_update(self):
-        remote_version, local_version = self.get_launcher_version_numbers()
-        if self.check_for_module_update(remote_version=remote_version, local_version=local_version):
-            self.logger.info("Downloading and running updater.py")
-            updater_url = self.repository_raw_host_url + self.launcher_repo_name + "/" + self.launcher_repo_branch + "/updater.py"
-            self.save_remote_file(updater_url, "updater.py")
-            self.restart_launcher(os.getcwd() + "/updater.py")
+    def update_launcher(self):
+        """ Downloads the latest updater.py and runs it in this process. The new launcher files take effect at the re-exec that ends the bootstrap. """
+        self.logger.info("Downloading and running updater.py")
+        updater_url = self.repository_raw_host_url + self.launcher_repo_name + "/" + self.launcher_repo_branch + "/updater.py"
+        if not self.save_remote_file(updater_url, "updater.py"):
+            self.logger.error("Error: Failed to download updater.py")
+            return False
+        updater = importlib.import_module("updater")
+        return updater.Updater(config=self.config, restart=False, tracer=self.tracer).updated
 
-    def activate_venv(self):
-        """ Activates the virtual environment. This function restarts the app and switches over to using the venv interpreter. """
-        # Check to see if the launcher is running with the default Python interpreter or the virtual environment interpreter
-        if sys.executable != self.venv_interpreter: # Check to see of the app is using the system interpreter.
-            import psutil   # Make module available in this function
-            if not os.path.isdir("venv"):   # Does the virtual environment folder exist?
-                if os.path.isdir(self.client_app_repo_name):     # Check to see the repository folder exists. If so, venv has been deleted. Reload repository from stable branch.
-                    subprocess.run(["rm", "-r", self.client_app_repo_name], stdout=subprocess.PIPE, text=True, check=True)   # Remove previous repository directory
-                    if os.path.isfile("config.txt"):    # Remove old config.txt as it is now outdated
-                        subprocess.run(["rm", "config.txt"], stdout=subprocess.PIPE, text=True, check=True)     # Remove previous config file
-                create_venv = subprocess.run(["virtualenv", "venv"], stdout=subprocess.PIPE, text=True, check=True) # Create a new virtual environment
-                if create_venv.returncode:
-                    self.logger.error("Error: Failed to create VirtualEnv")
-            self.restart_launcher(*sys.argv)
+    def get_venv_dir(self, app_dir):
+        """ Returns the pool venv of a version of the app. It is named by the hash of the version's requirements and the Python version. """
+        with open(app_dir + "/requirements/requirements.txt", "rb") as file:
+            digest = hashlib.sha256(f"{sys.version_info[0]}.{sys.version_info[1]}\n".encode() + file.read()).hexdigest()
+        return self.venv_pool + "/" + digest[:16]
+
+    def get_venv_interpreter(self, app_dir):
+        return os.getcwd() + "/" + self.get_venv_dir(app_dir) + "/bin/python"
+
+    def is_venv_complete(self, venv_dir) -> bool:
+        """ A venv is complete once its requirements have been installed. A venv without the marker was interrupted and is rebuilt. """
+        return os.path.isfile(venv_dir + "/.complete")
+
+    def select_venv(self, app_dir):
+        """ Points venv_interpreter and pip at the venv of app_dir, the version that is (or is about to be) launched """
+        self.venv_dir = self.get_venv_dir(app_dir)
+        self.venv_interpreter = os.getcwd() + "/" + self.venv_dir + "/bin/python"
+        self.pip = [self.venv_interpreter, "-m", "pip"]
+        self.venv_fingerprint_file = self.venv_dir + "/.launcher_fingerprint"
+
+    def create_venv(self, venv_dir, requirements_path) -> bool:
+        """ Creates the virtual environment as a copy of the pool venv closest to the requirements, so that pip only installs the difference. Without one it is built from nothing. """
+        if os.path.isdir(venv_dir):     # Left by an interrupted build
+            shutil.rmtree(venv_dir)
+        os.makedirs(self.venv_pool, exist_ok=True)
+        source = self.find_closest_venv(requirements_path)
+        if source:
+            self.logger.info(f"Creating {venv_dir} from {source}")
+            create_venv = self.tracer.run(["cp", "-a", source, venv_dir], stdout=subprocess.PIPE, text=True)
+            for marker in ["/.complete", "/.launcher_fingerprint"]:
+                if os.path.isfile(venv_dir + marker):
+                    os.remove(venv_dir + marker)
+            if not create_venv.returncode and not self.prune_venv(venv_dir, requirements_path):
+                return False
         else:
-            # Executes after application has restarted. Changes path variables to point to venv interpreter.
-            exec(open("venv/bin/activate_this.py").read(), {'__file__': "venv/bin/activate_this.py"})
-            if self.required_modules:   # List of modules required by this launcher
-                self.logger.debug("Updating modules required by launcher")
-                for module in self.required_modules:    # Install required modules using pip
-                    proc = subprocess.run(["pip", "install", module], capture_output=True, encoding="utf-8")
-                    self.logger.debug(proc.stdout)
-            installed_modules = subprocess.run(["pip", "list"], capture_output=True, encoding="utf-8")  # Get a list of installed modules registered by pip
-            result = installed_modules.stdout
-            # result = ' '.join(result.split())
-            # result = result[35:]
-            # i = iter(result.split(' '))
-            # ClaverNode = list(map(" ".join, zip(i, i)))
-            self.logger.debug(result)
+            create_venv = self.tracer.run(["virtualenv", venv_dir], stdout=subprocess.PIPE, text=True) # Create a new virtual environment
+        if create_venv.returncode:
+            self.logger.error("Error: Failed to create VirtualEnv")
+            return False
+        return True
 
-    def setup_logging(self, console=logging.INFO, file=logging.WARNING):
-        """ Set logger to capture different levels of information. Data logged to file differs (depending on settings) from data displayed to the console (stdout). """
-        if not os.path.isdir("logs"):   # Check to see if the logs directory exists
-            os.mkdir("logs")    # Create the directory
-        if os.path.isfile('logs/' + self.client_app_repo_name + '.log'):  # Logs will be retained on a per-run basis. Delete log from previous run.
-            os.remove('logs/' + self.client_app_repo_name + '.log')
-        # The first run of this program will create a log with the name of the repository.
-        if os.path.isfile('logs/' + self.client_app_repo_class_name + '.log'):  # Logs will be retained on a per-run basis. Delete log from previous run.
-            os.remove('logs/' + self.client_app_repo_class_name + '.log')
-        # Reset any previous locks on the logger
-        logging.getLogger().setLevel(logging.DEBUG)
-        logger = logging.getLogger('')
-        logger.handlers = []
+    def prune_venv(self, venv_dir, requirements_path) -> bool:
+        """ Uninstalls the distributions a copied venv brought along that the requirements do not need, so that a pool venv holds the same
+            distributions on every node however it was built. Missing ones are installed afterwards by install_client_app_requirements(). """
+        interpreter = os.getcwd() + "/" + venv_dir + "/bin/python"
+        unneeded = self.tracer.run([interpreter, "-c", UNNEEDED_DISTRIBUTIONS_SCRIPT] + self.load_requirements(requirements_path) + self.required_modules + BASE_DISTRIBUTIONS, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        if unneeded.returncode:
+            self.logger.error(f"Error: Unable to list the distributions of {venv_dir}: {unneeded.stderr}")
+            return False
+        names = unneeded.stdout.split()
+        if not names:
+            return True
+        self.logger.info(f"Removing {', '.join(names)} from {venv_dir}")
+        uninstall = self.tracer.run([interpreter, "-m", "pip", "uninstall", "-y"] + names, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        if uninstall.returncode:
+            self.logger.error(f"Error: Unable to remove unneeded distributions from {venv_dir}: {uninstall.stdout}")
+            return False
+        return True
 
-        self.logger = logging.getLogger(__name__)   # Set logger to name of module
-        # Create handlers
-        c_handler = logging.StreamHandler(stream=sys.stdout)    # Create console logger
-        f_handler = logging.FileHandler('logs/' + self.client_app_repo_name + '.log')    # Create file logger
-        c_handler.setLevel(console)     # Set logging level for console logger
-        f_handler.setLevel(file)        # Set logging level for file logger
+    def load_requirements(self, requirements_path) -> list:
+        """ Returns the requirement specifiers of a requirements file, without comments or pip options """
+        with open(requirements_path) as file:
+            lines = [line.split(" #")[0].strip() for line in file]
+        return [line for line in lines if line and not line.startswith(("#", "-"))]
 
-        # Create formatters and add them to handlers
-        c_format = logging.Formatter('%(message)s')
-        f_format = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        c_handler.setFormatter(c_format)
-        f_handler.setFormatter(f_format)
+    def find_closest_venv(self, requirements_path):
+        """ Returns the complete venv of the running Python version (including a venv/ left by earlier launchers) that has the most of the required distributions
+            installed and the fewest others, or None """
+        lines = self.load_requirements(requirements_path)
+        # Distribution names as they appear in metadata directories: lower case with dashes and dots replaced by underscores
+        required = {re.split(r"[<>=!~;\[\s@]", line, maxsplit=1)[0].lower().replace("-", "_").replace(".", "_") for line in lines}
+        required.update(module.lower() for module in self.required_modules)
+        candidates = [self.venv_pool + "/" + name for name in os.listdir(self.venv_pool) if self.is_venv_complete(self.venv_pool + "/" + name)]
+        if os.path.isfile("venv/bin/python"):
+            candidates.append("venv")
+        # A copy keeps the bin/python and lib/pythonX.Y of its source, so only venvs of the running Python version can be copied
+        python_version = f"{sys.version_info[0]}.{sys.version_info[1]}"
+        candidates = [venv_dir for venv_dir in candidates if self.get_venv_python_version(venv_dir) == python_version]
+        closest = None
+        best_score = None
+        for venv_dir in candidates:
+            installed = {entry.split("-")[0].lower().replace(".", "_") for entry in self.get_installed_distributions(venv_dir)}
+            score = (len(required & installed), -len(installed - required))
+            if best_score is None or score > best_score:
+                closest, best_score = venv_dir, score
+        return closest
 
-        # Add handlers to the logger
-        self.logger.addHandler(c_handler)
-        self.logger.addHandler(f_handler)
+    def ensure_venv_modules(self):
+        """ Installs launcher modules missing from the venv. Returns without spawning pip when the venv site-packages are unchanged since the last check. """
+        fingerprint = self.get_venv_fingerprint()
+        if os.path.isfile(self.venv_fingerprint_file):
+            with open(self.venv_fingerprint_file) as file:
+                if file.read() == fingerprint:     # Nothing has been installed or removed since the last check
+                    return
+        # Metadata directories are named <name>-<version> with dashes in the name replaced by underscores
+        installed = {entry.split("-")[0].lower() for entry in self.get_installed_distributions()}
+        missing_modules = [module for module in self.required_modules if module.lower().replace("-", "_") not in installed]
+        if missing_modules:   # Modules required by this launcher that are not yet in the venv
+            self.logger.debug("Installing modules required by launcher")
+            proc = self.tracer.run(self.pip + ["install"] + missing_modules, capture_output=True, encoding="utf-8")
+            self.logger.debug(proc.stdout)
+            fingerprint = self.get_venv_fingerprint()
+        self.logger.debug("\n".join(self.get_installed_distributions()))     # List of installed modules
+        with open(self.venv_fingerprint_file, "w") as file:
+            file.write(fingerprint)
 
-        self.logger.info(f'Log initialized for {self.client_app_repo_name}') # The minimum logging level for the file logger is set to WARNING
+    def activate_venv(self):
+        """ Activates the virtual environment. Changes path variables to point to the venv interpreter. """
+        activate_this = self.venv_dir + "/bin/activate_this.py"
+        exec(open(activate_this).read(), {'__file__': activate_this})
+
+    def setup_logging(self, console=logging.INFO, file=logging.WARNING):
+        """ Set logger to capture different levels of information. Data logged to file differs (depending on settings) from data displayed to the console (stdout).
+            Records are written to logs/launcher.log by a background thread. Earlier runs are kept compressed (log_pipeline.py). """
+        LogPipeline.setup("launcher", console=console, file=file, total_bytes=self.log_total_bytes)
+        self.logger = logging.getLogger(__name__)   # Set logger to name of module
+        self.logger.info(f'Log initialized for {self.client_app_repo_name}')
 
     def restart_launcher(self, target):
-        """ Restarts the current program """
-        self.install_launcher_dependencies(["psutil"])
+        """ Restarts the current program with the venv interpreter. The new process skips the bootstrap plan and goes straight to the app. """
         import psutil
+        LogPipeline.shutdown()  # Writes out queued records. The new process appends to the same log.
         try:
             p = psutil.Process(os.getpid())
             for handler in p.open_files() + p.connections():
                 os.close(handler.fd)
         except Exception as e:
-            self.logger.error("Error: Unable to close files and connections held by process", exc_info=True)
+            print("Error: Unable to close files and connections held by process", e)
+        self.tracer.record_exec(target)     # The new process continues the same timing report
+        os.environ["CLAVER_BOOTSTRAPPED"] = "1"
+        os.environ["CLAVER_EXEC_COUNT"] = str(self.exec_count + 1)   # Lets the new process (and tests) see how many re-execs this start has taken
+        if self.late_remote_checks:
+            os.environ["CLAVER_LATE_CHECKS"] = ",".join(self.late_remote_checks)
         # Relaunch application using virtual environment interpreter
         os.execl(self.venv_interpreter, self.venv_interpreter, target)
 
     def load_config_file(self, config):
         """ Read in the contents of JSON file (config.txt) """
-        with open(config) as file:
-            self.config = json.load(file)
+        self.config = ConfigStore.load(config)
 
     def save_config_file(self):
-        """ Save config information in JSON format to config.txt """
-        with open('config.txt', 'w') as outfile:
-            json.dump(self.config, outfile, indent=2, sort_keys=True)
+        """ Save config information in JSON format to config.txt. Nothing is written if the contents are unchanged. """
+        dirty_keys = self.config.dirty_keys()
+        if self.config.save():
+            self.logger.debug(f"Saved config.txt ({', '.join(dirty_keys)})")
 
     def load_local_version_number(self, path):
         """ Loads the version file from the local copy of the module and returns its values as a dictionary """
@@ -168,12 +437,53 @@ class Init:
 
     def load_repository_version_number(self, path):
         """ Downloads the version file from the remote copy of the module and returns its values as a dictionary """
-        import requests     # Make module available for this function
-        response = requests.get(path)
-        if response.status_code < 400:  # Make sure that the file was accessible
-            return response.json()
-        else:
-            return False
+        return self.fetcher.load_json(path)     # Returns False if the file was not accessible
+
+    def load_latest_release_tag(self, path):
+        """ Queries the releases API for the tag name of the latest published release """
+        release = self.load_repository_version_number(path)
+        if release:
+            return release.get("tag_name")
+        return False
+
+    def resolve_remote_versions(self, keys=None, budget=None):
+        """ Sends every remote version request at once so that startup waits on a single round trip instead of one per request.
+            Checks are bounded by budget (seconds, None waits for all). Results that arrive after the deadline are saved to config.txt for the next start.
+            Returns the keys of the checks that missed the deadline. """
+        from concurrent.futures import ThreadPoolExecutor, wait
+        pending = {
+            "launcher": (self.load_repository_version_number, self.repository_raw_host_url + self.launcher_repo_name + "/" + self.launcher_repo_branch + "/VERSION.txt")
+        }
+        if self.config is not None:     # Client app versions are only compared once a copy of the app has been installed
+            pending["client_app"] = (self.load_repository_version_number, self.repository_raw_host_url + self.client_app_repo_class_name + "/" + self.client_app_repo_branch + "/VERSION.txt")
+            # This value is only relevant when the client app module is loaded using a production build
+            pending["client_app_release"] = (self.load_latest_release_tag, self.repository_api_url + self.client_app_repo_class_name + "/releases/latest")
+            # Results that missed the deadline on a previous start stand in for any request that misses it again
+            self.remote_versions = self.config.pop("pending_remote_versions", {})
+        if keys is not None:
+            pending = {key: request for key, request in pending.items() if key in keys}
+        if not pending:
+            return []
+        executor = ThreadPoolExecutor(max_workers=len(pending))
+        futures = {key: executor.submit(function, url) for key, (function, url) in pending.items()}
+        wait(futures.values(), timeout=budget)
+        executor.shutdown(wait=False)   # Do not block the launch on requests that are still in flight
+        late_checks = []
+        for key, future in futures.items():
+            if not future.done():
+                if budget:
+                    self.logger.warning(f"Remote check for {key} exceeded the {budget}s budget. Launching installed version.")
+                future.add_done_callback(lambda late, key=key: self.save_late_remote_version(key, late))
+                late_checks.append(key)
+            elif future.result():
+                self.remote_versions[key] = future.result()
+        return late_checks
+
+    def save_late_remote_version(self, key, future):
+        """ Callback for remote checks that finished after the launch deadline. The result is written out with config.txt for use on the next start. """
+        if future.exception() is None and future.result():
+            with self.config.lock:
+                self.config.setdefault("pending_remote_versions", {})[key] = future.result()
 
     def check_for_module_update(self, remote_version, local_version) -> bool:
         """ Compares version values between local and remote copies of client module """
@@ -188,22 +498,19 @@ class Init:
             return False
 
     def download_client_app(self):
-        """ Ensures that a running copy of the app has been downloaded. ToDo: Roll back any failed version. """
+        """ Ensures that a running copy of the app has been downloaded """
         if self.config is None:
             config_path = "/interface/config.txt"
             config = self.client_app_repo_name + config_path
             if not os.path.isfile(config):
-                clone_git = subprocess.run(["git", "clone", "--single-branch", "--branch", self.client_app_repo_branch, self.client_app_repo_url, "t" + str(self.clock)], stdout=subprocess.PIPE, text=True, check=True)
-                if clone_git.returncode:
-                    self.logger.error(f"Error: Failed to clone app from {self.client_app_repo_url}: branch={self.client_app_repo_branch}")
+                app_dir = self.clone_client_app()
+                if not app_dir:
                     return False
-                self.client_app_repo_name = "t" + str(self.clock)   # Modules must not start with a number
-                # Install modules listed in requirements.txt
-                requirements_path = self.client_app_repo_name + "/requirements/requirements.txt"
-                install_requirements = subprocess.run(["pip", "install", "-r", requirements_path], stdout=subprocess.PIPE, text=True, check=True)
-                if install_requirements.returncode:
-                    self.logger.error("Error: Failed to load requirements.txt")
+                self.client_app_repo_name = app_dir
+                if not self.install_client_app_requirements(app_dir):     # Install modules listed in requirements.txt
                     return False
+                self.precompile_client_app(app_dir)
+                self.profile_client_app_import(app_dir)     # Nothing to fall back to on a first install. The profile is only recorded.
                 # Update path of config.txt
                 config = self.client_app_repo_name + config_path
                 if not os.path.isfile(config):
@@ -212,97 +519,431 @@ class Init:
                 self.load_config_file(config)
                 self.config["app_dir"] = self.client_app_repo_name   # Save the name of repository to config.txt
                 self.config["version"] = self.load_local_version_number(self.client_app_repo_name + "/VERSION.txt")
+                self.select_venv(self.client_app_repo_name)
+        return True
+
+    def clone_client_app(self):
+        """ Checks out the app into a new t<clock> directory and returns its name, or False on failure. Only objects missing from the local mirror are downloaded. """
+        start_time = time.monotonic()
+        while os.path.exists("t" + str(self.clock)):    # A resident launcher may upgrade more than once in the same second
+            self.clock += 1
+        if self.lan_cache_url:
+            app_dir = self.unpack_client_app_bundle()
+            if app_dir:
+                return app_dir
+        mirror_size = self.get_directory_size(self.client_app_mirror)
+        if not os.path.isdir(self.client_app_mirror):
+            os.makedirs(self.cache_dir, exist_ok=True)
+            create_mirror = self.tracer.run(["git", "clone", "--bare", self.client_app_repo_url, self.client_app_mirror], stdout=subprocess.PIPE, text=True)
+            if create_mirror.returncode:
+                self.logger.error(f"Error: Failed to create mirror of {self.client_app_repo_url}")
+                return False
+        # Fetch the branch into a ref of the same name. Objects already in the mirror are not transferred again.
+        fetch_git = self.tracer.run(["git", "--git-dir", self.client_app_mirror, "fetch", "--prune", self.client_app_repo_url, f"+refs/heads/{self.client_app_repo_branch}:refs/heads/{self.client_app_repo_branch}"], stdout=subprocess.PIPE, text=True)
+        if fetch_git.returncode:
+            self.logger.error(f"Error: Failed to fetch app from {self.client_app_repo_url}: branch={self.client_app_repo_branch}")
+            return False
+        bytes_transferred = self.get_directory_size(self.client_app_mirror) - mirror_size
+        app_dir = "t" + str(self.clock)     # Modules must not start with a number
+        # A shallow clone from the mirror copies only the files of the newest commit
+        clone_git = self.tracer.run(["git", "clone", "--depth", "1", "--single-branch", "--branch", self.client_app_repo_branch, "file://" + os.path.abspath(self.client_app_mirror), app_dir], stdout=subprocess.PIPE, text=True)
+        if clone_git.returncode:
+            self.logger.error(f"Error: Failed to check out app from {self.client_app_mirror}: branch={self.client_app_repo_branch}")
+            return False
+        self.logger.info(f"Fetched {bytes_transferred} bytes and checked out {app_dir} in {time.monotonic() - start_time:.2f}s")
+        return app_dir
+
+    def unpack_client_app_bundle(self):
+        """ Unpacks the newest bundle of the app from the LAN cache into a new t<clock> directory. Returns its name, or False if the cache cannot provide a verified bundle. """
+        # The entry-point class shares the name of the repository
+        index = self.fetcher.load_json(f"{self.lan_cache_url}bundles/{self.client_app_repo_class_name}/{self.client_app_repo_branch}.json")
+        if not index or not index.get("sha256"):
+            self.logger.warning("LAN cache has no bundle of the app. Cloning from the repository host.")
+            return False
+        bundle = self.cache_dir + "/bundles/" + os.path.basename(index["file"])
+        if self.fetcher.hash_file(bundle) != index["sha256"]:
+            if not self.fetcher.save_remote_file(self.lan_cache_url + index["file"], bundle) or self.fetcher.hash_file(bundle) != index["sha256"]:
+                self.logger.warning("Bundle from the LAN cache failed verification. Cloning from the repository host.")
+                return False
+        app_dir = "t" + str(self.clock)     # Modules must not start with a number
+        with tarfile.open(bundle) as archive:
+            if hasattr(tarfile, "data_filter"):
+                archive.extractall(app_dir, filter="data")  # Refuses absolute paths and links out of app_dir
+            else:
+                archive.extractall(app_dir)
+        os.remove(bundle)   # The unpacked copy is all that is needed
+        self.logger.info(f"Unpacked {index['file']} from the LAN cache into {app_dir}")
+        return app_dir
+
+    def install_client_app_requirements(self, app_dir):
+        """ Makes sure the pool venv of app_dir has the modules listed in requirements.txt. Skipped when a version with the same requirements already built it.
+            Packages are installed from a local wheelhouse so only new or changed wheels are built or fetched. """
+        requirements_path = app_dir + "/requirements/requirements.txt"
+        venv_dir = self.get_venv_dir(app_dir)
+        if self.is_venv_complete(venv_dir):
+            self.logger.info(f"Requirements unchanged. Using {venv_dir}.")
+            return True
+        if not self.create_venv(venv_dir, requirements_path):
+            return False
+        pip = [os.getcwd() + "/" + venv_dir + "/bin/python", "-m", "pip"]
+        requirements = ["-r", requirements_path] + self.required_modules    # Every venv can also run the launcher
+        os.makedirs(self.wheelhouse, exist_ok=True)
+        installed_before = set(self.get_installed_distributions(venv_dir))
+        # Wheels already in the wheelhouse satisfy their requirements without being downloaded or built again
+        build_wheels = None
+        if self.lan_cache_url:  # Take the missing wheels from the LAN cache alone before asking the package index
+            build_wheels = self.tracer.run(pip + ["wheel", "--no-index", "--find-links", self.wheelhouse, "--find-links", self.lan_cache_url + "wheels/", "--wheel-dir", self.wheelhouse] + requirements, stdout=subprocess.PIPE, text=True)
+        if build_wheels is None or build_wheels.returncode:
+            build_wheels = self.tracer.run(pip + ["wheel", "--prefer-binary", "--find-links", self.wheelhouse, "--wheel-dir", self.wheelhouse] + requirements, stdout=subprocess.PIPE, text=True)
+        if build_wheels.returncode:
+            self.logger.warning("Unable to populate wheelhouse. Installing requirements from the package index.")
+            install_requirements = self.tracer.run(pip + ["install"] + requirements, stdout=subprocess.PIPE, text=True)
         else:
-            remote_version, local_version = self.get_client_app_version_numbers()
-            if remote_version:  # Make sure the remote version file returned a value
-                if self.check_for_module_update(remote_version=remote_version, local_version=local_version):
-                    self.logger.info("Downloading update")
-                    self.upgrade_client_app()
+            install_requirements = self.tracer.run(pip + ["install", "--no-index", "--find-links", self.wheelhouse] + requirements, stdout=subprocess.PIPE, text=True)
+        if install_requirements.returncode:
+            self.logger.error("Error: Failed to load requirements.txt")
+            return False
+        self.precompile_distributions(venv_dir, set(self.get_installed_distributions(venv_dir)) - installed_before)
+        open(venv_dir + "/.complete", "w").close()
         return True
 
-    def get_client_app_version_numbers(self):
-        # This value is only relevant when the client app module is loaded using a production build
-        cmd = "curl -s https://api.github.com/repos/mccolm-robotics/" + self.client_app_repo_class_name + "/releases/latest | grep -oP '\"tag_name\": \"\K(.*)(?=\")'"
-        ps = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        release_ver = ps.communicate()[0]
-        # print(release_ver.decode())
-
-        local_version = self.load_local_version_number(self.client_app_repo_name + "/VERSION.txt")
-        # URL of version text file in remote repository
-        repository_path = self.repository_raw_host_url + self.client_app_repo_class_name + "/" + self.client_app_repo_branch + "/" + "VERSION.txt"
-        remote_version = self.load_repository_version_number(repository_path)
-        return remote_version, local_version
+    def precompile_client_app(self, app_dir):
+        """ Compiles the new version to bytecode so that its first launch does not """
+        # Unchecked hash-based .pyc files are loaded without reading or hashing the source, and they do not embed the checkout time. The version store
+        # hardlinks identical sources across versions, which gives them the mtime of the oldest copy and would make timestamp-based .pyc files stale.
+        # Trade-off: a source edited in place in a t<clock> directory is ignored until its .pyc is deleted. Versions are never edited once installed.
+        compile_app = self.tracer.run([self.get_venv_interpreter(app_dir), "-m", "compileall", "-q", "-j", "0", "--invalidation-mode", "unchecked-hash", app_dir], stdout=subprocess.PIPE, text=True)
+        if compile_app.returncode:
+            self.logger.warning(f"Unable to precompile {app_dir}: {compile_app.stdout}")
+
+    def precompile_distributions(self, venv_dir, distributions):
+        """ Compiles the modules of newly installed distributions. pip normally does this itself. Up-to-date modules are skipped, so this only costs time when it was turned off (e.g. PIP_NO_COMPILE). """
+        site_packages = self.get_venv_site_packages(venv_dir)
+        modules = []
+        for distribution in distributions:
+            record = os.path.join(site_packages, distribution, "RECORD")    # Lists every file the distribution installed
+            if os.path.isfile(record):
+                with open(record) as file:
+                    modules += [os.path.join(site_packages, line.split(",")[0]) for line in file if line.split(",")[0].endswith(".py")]
+        if modules:
+            self.tracer.run([os.getcwd() + "/" + venv_dir + "/bin/python", "-m", "compileall", "-q", "-j", "0", "-i", "-"], input="\n".join(modules), stdout=subprocess.PIPE, text=True)
+
+    def profile_client_app_import(self, app_dir, top=10) -> bool:
+        """ Imports the entry point in a separate interpreter with -X importtime. Writes the per-module profile to logs/importtime.txt and logs the slowest modules.
+            Returns False if the entry point cannot be imported. """
+        try:
+            profile = self.tracer.run([self.get_venv_interpreter(app_dir), "-X", "importtime", "-c", f"import {app_dir}.{self.client_app_repo_class_name}"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, timeout=120)
+        except subprocess.TimeoutExpired:
+            self.logger.warning(f"Import of {app_dir} took longer than 120s. No profile recorded.")
+            return True     # Slow, but not broken. The health check decides.
+        modules = []    # (cumulative us, self us, module)
+        for line in profile.stderr.splitlines():
+            fields = line[len("import time:"):].split("|") if line.startswith("import time:") else []
+            if len(fields) == 3 and fields[0].strip().isdigit():
+                modules.append((int(fields[1]), int(fields[0]), fields[2].rstrip()))
+        with open("logs/importtime.txt", "w") as file:
+            file.write(f"Import profile of {app_dir}.{self.client_app_repo_class_name} (exit status {profile.returncode})\n")
+            file.write(profile.stderr)
+        if profile.returncode:
+            self.logger.error(f"Error: Import of {app_dir}.{self.client_app_repo_class_name} failed. See logs/importtime.txt")
+            return False
+        total = max((cumulative for cumulative, _, module in modules if module.strip() == f"{app_dir}.{self.client_app_repo_class_name}"), default=0)
+        self.logger.info(f"Entry point of {app_dir} imports in {total / 1000:.0f}ms. Slowest of {len(modules)} modules loaded (cumulative / self ms):")
+        for cumulative, own, module in sorted(modules, reverse=True)[:top]:
+            self.logger.info(f"  {cumulative / 1000:8.1f} {own / 1000:8.1f}  {module.strip()}")
+        return True
+
+    def get_directory_size(self, path) -> int:
+        """ Returns the combined size in bytes of every file below path """
+        size = 0
+        for root, dirs, files in os.walk(path):
+            for name in files:
+                size += os.path.getsize(os.path.join(root, name))
+        return size
 
     def get_launcher_version_numbers(self):
         local_version = self.load_local_version_number("VERSION.txt")
-        # URL of version text file in remote repository
-        repository_path = self.repository_raw_host_url + self.launcher_repo_name + "/" + self.launcher_repo_branch + "/" + "VERSION.txt"
-        remote_version = self.load_repository_version_number(repository_path)
+        remote_version = self.remote_versions.get("launcher", False)   # Fetched by resolve_remote_versions()
         return remote_version, local_version
 
     def upgrade_client_app(self):
-        """ Download the newest version of the client app and restart app. """
-        clone_git = subprocess.run(["git", "clone", "--single-branch", "--branch", self.client_app_repo_branch, self.client_app_repo_url, "t" + str(self.clock)], stdout=subprocess.PIPE, text=True, check=True)
-        if clone_git.returncode:
-            self.logger.error(f"Error: Failed to clone app from {self.client_app_repo_url}: branch={self.client_app_repo_branch}")
-            return False
-        # Modules must not start with a number
-        self.client_app_repo_name = "t" + str(self.clock)
-        # Install modules listed in requirements.txt
-        requirements_path = self.client_app_repo_name + "/requirements/requirements.txt"
-        install_requirements = subprocess.run(["pip", "install", "-r", requirements_path], stdout=subprocess.PIPE, text=True, check=True)
-        if install_requirements.returncode:
-            self.logger.error("Error: Failed to load requirements.txt")
-            return False
-        self.config["previous_app_dir"] = self.config["app_dir"]
-        self.config["app_dir"] = self.client_app_repo_name
+        """ Switches to the newest version of the client app. A version staged in the background is used as is. Otherwise it is downloaded now.
+            The caller restarts the launcher if the new version must be loaded. """
+        if self.staging_thread is not None:
+            self.staging_thread.join()  # Let a download already under way finish rather than starting a second one
+        with self.upgrade_lock:
+            if self.get_staged_app_dir():
+                self.promote_staged_app()
+                return True
+            app_dir = self.clone_client_app()
+            if not app_dir:
+                return False
+            if not self.install_client_app_requirements(app_dir):     # Install modules listed in requirements.txt
+                return False
+            self.precompile_client_app(app_dir)
+            if not self.verify_client_app(app_dir):
+                self.version_store.remove(app_dir)
+                return False
+            version = self.load_local_version_number(app_dir + "/VERSION.txt")
+            if version in self.config.get("failed_versions", []):
+                self.logger.error(f"Error: Version {version} failed a previous health check. Not upgrading.")
+                self.version_store.remove(app_dir)
+                return False
+            self.begin_candidate(app_dir, version)  # Under the lock. Until app_dir is recorded, collect_versions() would take it for a failed upgrade.
+        return True
+
+    def get_staged_app_dir(self):
+        """ Returns the directory of a version staged by stage_client_app_upgrade(), or None if there is no usable one """
+        staged_app_dir = self.config.get("staged_app_dir")
+        if staged_app_dir and os.path.isdir(staged_app_dir):
+            return staged_app_dir
+        return None
+
+    def promote_staged_app(self):
+        """ Switches to the staged version. Everything was downloaded, installed and verified in the background, so only config values change. """
+        self.logger.info(f"Switching to staged version {self.config['staged_app_dir']}")
+        with self.config.lock:
+            self.begin_candidate(self.config.pop("staged_app_dir"), self.config.pop("staged_version"))
+
+    def begin_candidate(self, app_dir, version):
+        """ Makes app_dir the active version on probation. The version it replaces stays on disk as previous_app_dir until the candidate proves healthy. """
+        with self.config.lock:
+            self.config["previous_app_dir"] = self.config["app_dir"]
+            self.config["previous_version"] = self.config.get("version")
+            self.config["app_dir"] = self.client_app_repo_name = app_dir
+            self.config["version"] = version
+            self.select_venv(app_dir)   # Versions with the same requirements share a venv. Others switch to their own, built when they were installed.
+            self.config["app_state"] = "candidate"
+            self.config["candidate_launches"] = 0
+
+    def start_health_check(self):
+        """ Called as a candidate version is launched. Records the launch and starts the timer that promotes the candidate to healthy. """
+        if self.config.get("app_state") != "candidate":
+            return
+        self.config["candidate_launches"] = self.config.get("candidate_launches", 0) + 1
+        self.save_config_file()     # Lets the next start see an unfinished health check if the node goes down with the candidate
+        self.health_timer = threading.Timer(self.health_check_timeout, self.mark_client_app_healthy)
+        self.health_timer.daemon = True
+        self.health_timer.start()
+
+    def mark_client_app_healthy(self):
+        """ The candidate kept running (or reported a status) for health_check_timeout seconds and becomes the trusted version """
+        with self.config.lock:  # The timer thread and the main thread may both get here
+            if self.config.get("app_state") != "candidate":
+                return
+            self.logger.info(f"{self.config['app_dir']} passed its health check")
+            self.config["app_state"] = "healthy"
+            self.config.pop("candidate_launches", None)
         self.save_config_file()
-        self.restart_launcher(*sys.argv)
+
+    def evaluate_client_app_health(self, run_time) -> bool:
+        """ Decides the fate of a candidate version once it exits. Returns True if the launcher rolled back to the previous version. """
+        if self.health_timer is not None:
+            self.health_timer.cancel()
+        with self.config.lock:  # A timer that already fired may be marking the candidate healthy
+            if self.config.get("app_state") != "candidate":
+                return False
+            if self.action_request is not None or run_time >= self.health_check_timeout:
+                self.mark_client_app_healthy()
+                return False
+            return self.rollback_client_app()
+
+    def rollback_client_app(self) -> bool:
+        """ Returns to the retained previous version. Its directory is still on disk, so nothing is downloaded or installed. """
+        with self.config.lock:
+            failed_app_dir = self.config["app_dir"]
+            previous_app_dir = self.config.get("previous_app_dir")
+            self.config["app_state"] = "healthy"
+            self.config.pop("candidate_launches", None)
+            if not previous_app_dir or not os.path.isdir(previous_app_dir):
+                self.logger.error(f"Error: {failed_app_dir} failed its health check and there is no previous version to roll back to")
+                return False
+            self.logger.error(f"{failed_app_dir} failed its health check. Rolling back to {previous_app_dir}")
+            self.config.setdefault("failed_versions", []).append(self.config["version"])   # Never staged or installed again
+            self.config["app_dir"] = self.client_app_repo_name = previous_app_dir
+            self.config["version"] = self.config.pop("previous_version", None) or self.load_local_version_number(previous_app_dir + "/VERSION.txt")
+            self.select_venv(previous_app_dir)  # Its venv is kept for as long as the version is
+            del self.config["previous_app_dir"]
+        self.version_store.remove(failed_app_dir)
+        self.rolled_back = True
+        return True
+
+    def start_background_staging(self):
+        """ Starts stage_client_app_upgrade() in a background thread unless it is already running """
+        if self.staging_thread is None or not self.staging_thread.is_alive():
+            self.staging_thread = threading.Thread(target=self.stage_client_app_upgrade, name="stage_client_app_upgrade")
+            self.staging_thread.start()
+
+    def start_version_collection(self):
+        """ Starts collect_versions() in a background thread unless it is already running """
+        if self.collection_thread is None or not self.collection_thread.is_alive():
+            self.collection_thread = threading.Thread(target=self.collect_versions, name="collect_versions")
+            self.collection_thread.start()
+
+    def collect_versions(self):
+        """ Removes versions of the app that are no longer needed and hardlinks identical files across the rest """
+        try:
+            with self.upgrade_lock:     # Waits for staging, so that a version being checked out is never mistaken for a failed one
+                protected = [self.config.get(key) for key in ("app_dir", "previous_app_dir", "staged_app_dir") if self.config.get(key)]
+                self.version_store.collect(self.config["app_dir"], protected)
+                self.collect_venvs()
+        except Exception:
+            self.logger.error("Error: Removing old versions of the app failed", exc_info=True)
+
+    def collect_venvs(self):
+        """ Removes pool venvs that no remaining version of the app uses, and the single venv/ of earlier launchers once it has been replaced """
+        if not os.path.isdir(self.venv_pool):
+            return
+        used = set()
+        for app_dir in self.version_store.list_versions():
+            if os.path.isfile(app_dir + "/requirements/requirements.txt"):
+                used.add(self.get_venv_dir(app_dir))
+        if os.path.dirname(os.path.realpath(sys.prefix)) == os.path.realpath(self.venv_pool):
+            used.add(self.venv_pool + "/" + os.path.basename(os.path.realpath(sys.prefix)))   # The launcher runs from it, e.g. a supervisor after a rollback
+        for name in os.listdir(self.venv_pool):
+            if self.venv_pool + "/" + name not in used:
+                self.version_store.remove(self.venv_pool + "/" + name)
+        if os.path.isdir("venv") and self.is_venv_complete(self.venv_dir) and os.path.abspath(sys.prefix) != os.path.abspath("venv"):
+            self.version_store.remove("venv")
+        self.version_store.empty_trash()
+
+    def stage_client_app_upgrade(self):
+        """ Runs while the app is in use. Downloads, installs and verifies the next version into a t<clock> directory and records it as staged_app_dir for the next start. """
+        try:
+            with self.upgrade_lock, self.tracer.phase("stage_client_app_upgrade"):
+                # The result of the startup check is used once. Later passes (each run of a resident supervisor) ask again, so releases published
+                # since the start are seen. An unchanged VERSION.txt costs a single 304 response.
+                remote_version = self.remote_versions.pop("client_app", None)
+                if not remote_version:
+                    remote_version = self.load_repository_version_number(self.repository_raw_host_url + self.client_app_repo_class_name + "/" + self.client_app_repo_branch + "/VERSION.txt")
+                if not remote_version:
+                    return
+                local_version = self.load_local_version_number(self.config["app_dir"] + "/VERSION.txt")
+                if not self.check_for_module_update(remote_version=remote_version, local_version=local_version):
+                    return
+                if remote_version in self.config.get("failed_versions", []):
+                    return  # This version already failed a health check on this node
+                if self.get_staged_app_dir() and not self.check_for_module_update(remote_version=remote_version, local_version=self.config["staged_version"]):
+                    return  # The newest version is already staged
+                app_dir = self.clone_client_app()
+                if not app_dir or not self.install_client_app_requirements(app_dir):
+                    self.logger.error("Error: Failed to stage the next version of the app")
+                    return
+                self.precompile_client_app(app_dir)
+                if not self.verify_client_app(app_dir, remote_version):
+                    self.logger.error("Error: Failed to stage the next version of the app")
+                    self.version_store.remove(app_dir)
+                    return
+                staged_version = self.load_local_version_number(app_dir + "/VERSION.txt")
+                with self.config.lock:  # A save never records one of the pair without the other
+                    self.config["staged_app_dir"] = app_dir
+                    self.config["staged_version"] = staged_version
+                self.logger.info(f"Staged {app_dir} for the next start")
+        except Exception:
+            self.logger.error("Error: Staging the next version of the app failed", exc_info=True)
+
+    def verify_client_app(self, app_dir, expected_version=None) -> bool:
+        """ Checks that a checked-out version is complete, is the version that was advertised (if given) and that its entry point imports """
+        for path in ["/VERSION.txt", "/interface/config.txt", "/" + self.client_app_repo_class_name + ".py"]:
+            if not os.path.isfile(app_dir + path):
+                self.logger.error(f"Error: {app_dir + path} is missing")
+                return False
+        local_version = self.load_local_version_number(app_dir + "/VERSION.txt")
+        if expected_version and self.check_for_module_update(remote_version=expected_version, local_version=local_version):
+            self.logger.error(f"Error: {app_dir} is older than the advertised version")
+            return False
+        return self.profile_client_app_import(app_dir)  # Also records the import profile in logs/importtime.txt
 
     def client_app_exit_status(self, val, **kwargs):
         """ Callback function passed to application module. GTK does not allow setting the exit status directly. """
         self.action_request = val
 
     def launch_client_app(self):
-        """ Dynamically loads app based on repository name. Assumes main class matches repository name. Deletes previously installed version of the app. """
-        # Import the module
-        mod = importlib.import_module(f'{self.client_app_repo_name}.{self.client_app_repo_class_name}')
-        # Determine a list of names to copy to the current name space
-        names = getattr(mod, '__all__', [n for n in dir(mod) if not n.startswith('_')])
-        # Copy the name of the entry-point class into the current name space
-        g = globals()
-        for name in names:
-            # Look for the class that matches the repository name
-            if name == self.client_app_repo_class_name:
-                entry_point = getattr(mod, name)
-                g[name] = entry_point
-        self.application = entry_point(self.client_app_exit_status)    # Instantiate app class
-        self.config["app_exit_status"] = self.application.run()     # Entry-point for GTK applications is run()
-        if "previous_app_dir" in self.config \
-                and not self.config["app_exit_status"] \
-                and os.path.isdir(self.config["previous_app_dir"]): # If app ran without error (exit-status == 0), check for previous version of app and delete directory
-            self.logger.info("Removing previous version directory")
-            subprocess.run(["rm", "-r", self.config["previous_app_dir"]], stdout=subprocess.PIPE, text=True, check=True)
-            if os.path.isfile('logs/' + self.config["previous_app_dir"] + '.log'):  # Logs will be retained on a per-run basis. Delete log from previous run.
-                os.remove('logs/' + self.config["previous_app_dir"] + '.log')
-            if not os.path.isdir(self.config["previous_app_dir"]):  # Make sure the directory was deleted
-                del self.config["previous_app_dir"]     # Remove key from the config dictionary
+        """ Dynamically loads app based on repository name. Assumes main class matches repository name. """
+        self.start_health_check()   # Counts the launch before the import, so a version that cannot even be imported is rolled back
+        started = time.monotonic()
+        try:
+            with self.tracer.phase("import_client_app"):
+                entry_point = load_client_app_entry_point(self.client_app_repo_name, self.client_app_repo_class_name)
+            globals()[self.client_app_repo_class_name] = entry_point     # Copy the name of the entry-point class into the current name space
+            with self.tracer.phase("start_client_app"):
+                self.application = entry_point(self.client_app_exit_status)    # Instantiate app class
+            self.tracer.save()  # Everything up to here is on the path to the first frame
+            with self.tracer.phase("run_client_app"):
+                self.config["app_exit_status"] = self.application.run()     # Entry-point for GTK applications is run()
+        except Exception:
+            if self.health_timer is not None:
+                self.health_timer.cancel()
+            with self.config.lock:
+                rolled_back = self.config.get("app_state") == "candidate" and self.rollback_client_app()
+            if not rolled_back:
+                raise   # A trusted version crashed, or there is nothing to return to
+            self.logger.error("Error: The app raised an exception", exc_info=True)
+            self.action_request = None
+            self.config["app_exit_status"] = 1
+            return
+        self.evaluate_client_app_health(time.monotonic() - started)
+        if not self.config["app_exit_status"]:  # If app ran without error (exit-status == 0), the previous version is no longer needed for a roll-back
+            self.release_previous_app_dir()
+
+    def release_previous_app_dir(self):
+        """ Stops protecting the version the app was upgraded from. It is kept for rollback while the current version is a candidate.
+            The directory itself is left to the version store, which keeps the newest retained_versions. """
+        if self.config.get("app_state") == "candidate":
+            return
+        self.config.pop("previous_app_dir", None)
+        self.config.pop("previous_version", None)
+
+    def supervise_client_app(self):
+        """ Keeps the launcher resident and runs the app in a child process. Crashes are restarted with exponential backoff.
+            Action requests are handled here, so venv activation, dependency checks and logging setup are never repeated. """
+        backoff = 1
+        while True:
+            self.start_background_staging()
+            self.start_version_collection()
+            self.start_health_check()
+            started = time.monotonic()
+            with self.tracer.phase("run_client_app"):
+                child = self.tracer.run([self.venv_interpreter, os.path.abspath(__file__), "--run-client-app", self.client_app_repo_name, self.client_app_repo_class_name])
+            self.action_request = child.returncode - ACTION_EXIT_BASE if child.returncode - ACTION_EXIT_BASE in ACTION_REQUESTS else None
+            self.config["app_exit_status"] = 0 if self.action_request is not None else child.returncode     # Matches run() returning 0 for an orderly exit
+            self.config["action_request"] = self.action_request
+            self.logger.info(f"Exit Status: {self.action_request}")
+            if self.evaluate_client_app_health(time.monotonic() - started):
+                self.save_config_file()
+                continue    # Start the restored version immediately
+            if self.action_request is None:
+                if time.monotonic() - started > self.supervisor_max_backoff:    # The app ran for a while before failing. Start counting again.
+                    backoff = 1
+                self.logger.error(f"App exited with status {child.returncode}. Restarting in {backoff}s")
+                self.save_config_file()
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.supervisor_max_backoff)
+                continue
+            backoff = 1
+            self.release_previous_app_dir()
+            if "previous_launcher_files" in self.config:
+                self.cleanup_previous_upgrade()
+            if self.action_request == 0:
+                self.logger.info("Client app did not request additional action")
+                return
+            elif self.action_request == 1:
+                self.logger.info("Request to upgrade app")
+                with self.tracer.phase("upgrade_client_app"):
+                    self.upgrade_client_app()   # The next child process loads the new version
+            elif self.action_request == 2:
+                self.logger.info("Request to run app in development mode")
+                # ToDo: set dev mode in config.txt before restarting the app
+            self.save_config_file()
 
     def cleanup_previous_upgrade(self):
-        if os.path.isfile(self.config["previous_launcher"]):
-            os.remove(self.config["previous_launcher"])
-            print(f"Deleting {self.config['previous_launcher']}")
-        if "previous_launcher_version" in self.config:
-            if os.path.isfile(self.config["previous_launcher_version"]):
-                os.remove(self.config["previous_launcher_version"])
-                print(f"Deleting {self.config['previous_launcher_version']}")
-        if "updater_log_file" in self.config:
-            if os.path.isfile('logs/' + self.config["updater_log_file"]):
-                os.remove('logs/' + self.config["updater_log_file"])
-                print(f"Deleting {self.config['updater_log_file']}")
-        del self.config["previous_launcher"]
-        del self.config["previous_launcher_version"]
-        del self.config["updater_log_file"]
+        """ The new launcher has started. Deletes the launcher files it replaced. """
+        for name, digest in self.config["previous_launcher_files"].items():
+            if os.path.isfile("cache/launcher/" + digest):
+                os.remove("cache/launcher/" + digest)
+                print(f"Deleting previous {name}")
+        del self.config["previous_launcher_files"]
+        self.config.pop("updater_log_file", None)   # Written by earlier updaters
 
     def evaluate_client_app_action_request(self):
         """ Action any requests sent by the app """
@@ -310,21 +951,51 @@ class Init:
         self.logger.info(f"Exit Status: {self.action_request}")
         if self.action_request is None:
             self.logger.error("App failed to start")
-            # ToDo: Implement roll-back if FAIL follows update to new version
+            if self.rolled_back:    # Start the restored version immediately. It is already installed.
+                self.save_config_file()
+                self.exec_count = 0
+                self.restart_launcher(os.getcwd() + "/init.py")
             # ToDo: Save log file and upload to server / email to maintainer
         else:
             if self.action_request == 0:
                 print("Client app did not request additional action")
             elif self.action_request == 1:
                 print("Request to upgrade app")
-                self.upgrade_client_app()
+                if self.upgrade_client_app():
+                    self.save_config_file()
+                    self.exec_count = 0     # The upgraded app is loaded by a new start of the launcher
+                    self.restart_launcher(os.getcwd() + "/init.py")
             elif self.action_request == 2:
                 print("Request to run app in development mode")
                 # ToDo: set dev mode in config.txt and restart launcher
-            if "previous_launcher" in self.config:
+            if "previous_launcher_files" in self.config:
                 self.cleanup_previous_upgrade()
 
+def load_client_app_entry_point(app_dir, class_name):
+    """ Imports <app_dir>.<class_name> and returns the entry-point class whose name matches the repository name """
+    mod = importlib.import_module(f'{app_dir}.{class_name}')
+    # Determine a list of names exported by the module
+    names = getattr(mod, '__all__', [n for n in dir(mod) if not n.startswith('_')])
+    if class_name not in names:
+        raise ImportError(f"{app_dir}.{class_name} does not define {class_name}")
+    return getattr(mod, class_name)
+
+
+def run_client_app(app_dir, class_name):
+    """ Child process of the supervisor. Runs the app and reports its action request through the exit status. """
+    action_request = []
+    LogPipeline.setup("client_app", console=logging.DEBUG, file=logging.INFO)     # Each run of the child process rotates logs/client_app.log
+    entry_point = load_client_app_entry_point(app_dir, class_name)
+    application = entry_point(lambda val, **kwargs: action_request.append(val))
+    application.run()
+    if not action_request or action_request[-1] is None:
+        return 1    # The app never reported a status. Treated as a failure to start.
+    return ACTION_EXIT_BASE + int(action_request[-1])
+
+
 if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "--run-client-app":
+        sys.exit(run_client_app(sys.argv[2], sys.argv[3]))
     Init()
 
 
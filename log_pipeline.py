@@ -0,0 +1,94 @@
+import atexit
+import glob
+import gzip
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import sys
+
+
+class CompressingRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """ Rotates <name>.log into <name>.log.1.gz ... <name>.log.<backup_count>.gz and then deletes the oldest compressed logs until log_dir is under total_bytes """
+    def __init__(self, file_name, max_bytes, backup_count, total_bytes):
+        super().__init__(file_name, maxBytes=max_bytes, backupCount=backup_count, delay=True)
+        self.total_bytes = total_bytes
+        self.namer = lambda name: name + ".gz"
+        self.rotator = self.compress
+
+    def compress(self, source, dest):
+        with open(source, "rb") as source_file, gzip.open(dest, "wb") as dest_file:
+            shutil.copyfileobj(source_file, dest_file)
+        os.remove(source)
+
+    def doRollover(self):
+        super().doRollover()
+        self.enforce_total_bytes()
+
+    def enforce_total_bytes(self):
+        """ Deletes compressed logs, oldest first, while everything in the log directory adds up to more than total_bytes """
+        log_dir = os.path.dirname(self.baseFilename)
+        files = [os.path.join(log_dir, name) for name in os.listdir(log_dir) if os.path.isfile(os.path.join(log_dir, name))]
+        size = sum(os.path.getsize(path) for path in files)
+        for path in sorted(glob.glob(log_dir + "/*.gz"), key=os.path.getmtime):
+            if size <= self.total_bytes:
+                break
+            size -= os.path.getsize(path)
+            os.remove(path)
+
+
+class LogPipeline:
+    """ Logging for the launcher, updater and cache server. Callers only put records on a queue. A background thread writes them to the console and to a
+        rotating, compressed log file. Each start rotates the log once. The processes that follow a re-exec carry on writing to the same file. """
+    active = None   # The pipeline of this process. Set up once and shared by every component that logs.
+
+    def __init__(self, name, log_dir="logs", max_bytes=1024 * 1024, backup_count=10, total_bytes=20 * 1024 * 1024):
+        self.name = name    # Log file is <log_dir>/<name>.log
+        self.log_dir = log_dir
+        self.max_bytes = max_bytes  # A log that grows past this size is rotated during the run
+        self.backup_count = backup_count    # Number of earlier runs (or rotated chunks) kept compressed
+        self.total_bytes = total_bytes  # Cap on everything kept in log_dir
+        self.queue = queue.SimpleQueue()
+        self.listener = None
+        self.file_handler = None
+
+    @classmethod
+    def setup(cls, name, console=logging.INFO, file=logging.WARNING, **limits):
+        """ Starts the pipeline of this process, or returns the one already running """
+        if cls.active is None:
+            cls.active = cls(name, **limits)
+            cls.active.start(console, file)
+        return cls.active
+
+    @classmethod
+    def shutdown(cls):
+        """ Writes out every queued record and closes the log file. Must be called before os.execl(), which skips atexit handlers. """
+        if cls.active is not None:
+            cls.active.stop()
+            cls.active = None
+
+    def start(self, console, file):
+        os.makedirs(self.log_dir, exist_ok=True)
+        self.file_handler = CompressingRotatingFileHandler(self.log_dir + "/" + self.name + ".log", self.max_bytes, self.backup_count, self.total_bytes)
+        self.file_handler.setLevel(file)
+        self.file_handler.setFormatter(logging.Formatter('%(asctime)s - %(process)d - %(name)s - %(levelname)s - %(message)s'))
+        c_handler = logging.StreamHandler(stream=sys.stdout)
+        c_handler.setLevel(console)
+        c_handler.setFormatter(logging.Formatter('%(message)s'))
+        # The first process of a start sets the marker. Processes it re-execs into inherit it and append to the same log.
+        started = os.environ.get("CLAVER_LOGS_STARTED", "").split(",")
+        if self.name not in started:
+            if os.path.isfile(self.file_handler.baseFilename) and os.path.getsize(self.file_handler.baseFilename):
+                self.file_handler.doRollover()  # Keep the previous run, compressed
+            os.environ["CLAVER_LOGS_STARTED"] = ",".join([name for name in started if name] + [self.name])
+        root = logging.getLogger()
+        root.setLevel(logging.DEBUG)
+        root.handlers = [logging.handlers.QueueHandler(self.queue)]     # The app's own loggers propagate here as well
+        self.listener = logging.handlers.QueueListener(self.queue, c_handler, self.file_handler, respect_handler_level=True)
+        self.listener.start()
+        atexit.register(LogPipeline.shutdown)
+
+    def stop(self):
+        self.listener.stop()
+        self.file_handler.close()
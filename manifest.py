@@ -0,0 +1,57 @@
+import hashlib
+import json
+import os
+import sys
+
+"""
+Writes MANIFEST.json, the list of launcher files and their SHA-256 digests that nodes use to update themselves.
+Run it after changing any launcher file and commit the result with the release: python manifest.py [DIRECTORY]
+A node rejects every file whose digest does not match, so a stale manifest stops nodes from updating. Check before committing: python manifest.py --check [DIRECTORY]
+"""
+
+LAUNCHER_FILES = ["init.py", "updater.py", "fetcher.py", "tracer.py", "config_store.py", "log_pipeline.py", "version_store.py", "cache_server.py", "VERSION.txt"]     # Files that make up a launcher release
+MANIFEST_FILE = "MANIFEST.json"
+
+
+def hash_file(path):
+    """ Returns the SHA-256 digest of a file """
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(65536), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def build_manifest(directory="."):
+    """ Returns the manifest of the launcher files in directory """
+    with open(os.path.join(directory, "VERSION.txt")) as file:
+        version = json.load(file)
+    files = {name: hash_file(os.path.join(directory, name)) for name in LAUNCHER_FILES}
+    return {"version": version, "files": files}
+
+
+def write_manifest(directory="."):
+    with open(os.path.join(directory, MANIFEST_FILE), "w") as file:
+        json.dump(build_manifest(directory), file, indent=2, sort_keys=True)
+        file.write("\n")
+
+
+def check_manifest(directory=".") -> list:
+    """ Returns the names whose entry in the committed MANIFEST.json differs from the files in directory. An empty list means it is up to date. """
+    with open(os.path.join(directory, MANIFEST_FILE)) as file:
+        committed = json.load(file)
+    current = build_manifest(directory)
+    stale = sorted(name for name in set(current["files"]) | set(committed.get("files", {})) if current["files"].get(name) != committed.get("files", {}).get(name))
+    if current["version"] != committed.get("version"):
+        stale.append("version")
+    return stale
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--check":
+        stale = check_manifest(sys.argv[2] if len(sys.argv) > 2 else ".")
+        if stale:
+            print(f"{MANIFEST_FILE} is out of date for: {', '.join(stale)}. Run python manifest.py")
+            sys.exit(1)
+    else:
+        write_manifest(sys.argv[1] if len(sys.argv) > 1 else ".")
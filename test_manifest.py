@@ -0,0 +1,18 @@
+import os
+import unittest
+from manifest import check_manifest
+
+"""
+Checks that the committed MANIFEST.json matches the launcher files. Nodes refuse files whose digest differs, so a stale manifest blocks every update.
+Usage: python -m unittest test_manifest
+"""
+
+
+class ManifestTest(unittest.TestCase):
+    def test_manifest_is_current(self):
+        stale = check_manifest(os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(stale, [], "MANIFEST.json is out of date. Run python manifest.py")
+
+
+if __name__ == "__main__":
+    unittest.main()
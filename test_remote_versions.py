@@ -0,0 +1,99 @@
+import http.server
+import json
+import logging
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from config_store import ConfigStore
+from fetcher import Fetcher
+from init import Init
+
+"""
+Checks that the remote version requests of a start are sent together rather than one after another.
+A local HTTP server stands in for raw.githubusercontent.com and api.github.com and answers each endpoint after its own delay.
+Usage: python -m unittest test_remote_versions
+"""
+
+ORGANISATION = "mccolm-robotics"
+RESPONSES = {   # Path: (seconds before the answer, JSON document)
+    "/ClaverLauncher/stable/VERSION.txt": (0.4, {"MAJOR": "0", "MINOR": "3", "PATCH": "1"}),
+    "/ClaverMessageBoard/stable/VERSION.txt": (0.8, {"MAJOR": "0", "MINOR": "2", "PATCH": "0"}),
+    f"/repos/{ORGANISATION}/ClaverMessageBoard/releases/latest": (1.2, {"tag_name": "v0.2.0"}),
+}
+
+
+class DelayedHandler(http.server.BaseHTTPRequestHandler):
+    """ Answers each endpoint in RESPONSES once its delay has passed """
+    def do_GET(self):
+        if self.path not in RESPONSES:
+            self.send_error(404)
+            return
+        delay, document = RESPONSES[self.path]
+        time.sleep(delay)
+        body = json.dumps(document).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class RemoteVersionsTest(unittest.TestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), DelayedHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.cache_dir = tempfile.mkdtemp(prefix="claver-test-")
+        self.launcher = self.make_launcher(f"http://127.0.0.1:{self.server.server_address[1]}/")
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def make_launcher(self, base_url):
+        """ Returns an Init with only the state resolve_remote_versions() uses. Init() itself would run the whole launcher. """
+        launcher = Init.__new__(Init)
+        launcher.logger = logging.getLogger(__name__)
+        launcher.repository_raw_host_url = base_url
+        launcher.repository_api_url = base_url + f"repos/{ORGANISATION}/"
+        launcher.launcher_repo_name = "ClaverLauncher"
+        launcher.launcher_repo_branch = "stable"
+        launcher.client_app_repo_class_name = "ClaverMessageBoard"
+        launcher.client_app_repo_branch = "stable"
+        launcher.config = ConfigStore({"app_dir": "t1"}, path=self.cache_dir + "/config.txt")
+        launcher.remote_versions = {}
+        launcher.fetcher = Fetcher(cache_dir=self.cache_dir, timeout=5, logger=launcher.logger)
+        return launcher
+
+    def test_requests_overlap(self):
+        """ All three checks finish in about the time of the slowest one, not the sum of the three """
+        started = time.monotonic()
+        late_checks = self.launcher.resolve_remote_versions()
+        elapsed = time.monotonic() - started
+        slowest = max(delay for delay, _ in RESPONSES.values())
+        total = sum(delay for delay, _ in RESPONSES.values())
+        self.assertEqual(late_checks, [])
+        self.assertGreaterEqual(elapsed, slowest)
+        self.assertLess(elapsed, slowest + (total - slowest) / 2)
+        self.assertEqual(self.launcher.remote_versions["launcher"], RESPONSES["/ClaverLauncher/stable/VERSION.txt"][1])
+        self.assertEqual(self.launcher.remote_versions["client_app"], RESPONSES["/ClaverMessageBoard/stable/VERSION.txt"][1])
+        self.assertEqual(self.launcher.remote_versions["client_app_release"], "v0.2.0")
+
+    def test_budget_defers_slow_checks(self):
+        """ Checks still in flight at the deadline are reported as late and saved for the next start once they finish """
+        started = time.monotonic()
+        late_checks = self.launcher.resolve_remote_versions(budget=0.6)
+        self.assertLess(time.monotonic() - started, 0.8)
+        self.assertEqual(sorted(late_checks), ["client_app", "client_app_release"])
+        self.assertIn("launcher", self.launcher.remote_versions)
+        time.sleep(1)
+        self.assertEqual(self.launcher.config["pending_remote_versions"], {"client_app": RESPONSES["/ClaverMessageBoard/stable/VERSION.txt"][1], "client_app_release": "v0.2.0"})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+import atexit
+import contextlib
+import glob
+import json
+import os
+import subprocess
+import tempfile
+import threading
+import time
+
+
+class StartupTracer:
+    """ Times the phases, subprocesses and HTTP requests of a start and writes them to a JSON report in logs/. The report is carried over when the launcher re-execs itself. """
+    def __init__(self, report_dir="logs", retained_reports=10):
+        self.report_dir = report_dir
+        self.retained_reports = retained_reports    # Number of start reports kept in report_dir
+        self.lock = threading.Lock()    # Subprocesses and requests may be recorded from several threads
+        self.report_file = os.environ.get("CLAVER_TRACE_FILE")     # Set by a process that re-exec'd into this one
+        self.report = None
+        if self.report_file and os.path.isfile(self.report_file):
+            try:
+                with open(self.report_file) as file:
+                    self.report = json.load(file)
+            except ValueError:
+                self.report = None
+        if self.report is None:     # First process of a new start
+            started = time.time()
+            self.report_file = report_dir + "/startup-" + time.strftime("%Y%m%d-%H%M%S", time.localtime(started)) + f"-{os.getpid()}.json"
+            self.report = {"started": started, "pid": os.getpid(), "execs": 0, "events": []}
+        self.started = self.report["started"]
+        os.environ["CLAVER_TRACE_FILE"] = self.report_file     # Inherited across os.execl()
+        atexit.register(self.save)
+
+    def offset(self, moment=None) -> float:
+        """ Seconds between the start of the launcher and moment (default now) """
+        return round((moment or time.time()) - self.started, 4)
+
+    def record(self, kind, name, started, duration, **details):
+        """ Adds a timed event to the report. started is a time.time() value. """
+        event = {"kind": kind, "name": name, "start": self.offset(started), "duration": round(duration, 4), "exec": self.report["execs"]}
+        event.update(details)
+        with self.lock:
+            self.report["events"].append(event)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """ Context manager that times a named phase of the start """
+        started = time.time()
+        clock = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record("phase", name, started, time.monotonic() - clock)
+
+    def run(self, args, **kwargs):
+        """ Drop-in replacement for subprocess.run() that records the duration and exit status of the command """
+        started = time.time()
+        clock = time.monotonic()
+        returncode = None
+        try:
+            result = subprocess.run(args, **kwargs)
+            returncode = result.returncode
+            return result
+        except subprocess.CalledProcessError as error:
+            returncode = error.returncode
+            raise
+        finally:
+            command = args if isinstance(args, str) else " ".join(str(arg) for arg in args)
+            self.record("subprocess", command, started, time.monotonic() - clock, returncode=returncode)
+
+    def record_exec(self, target):
+        """ Marks the point where the launcher replaces itself with os.execl() and saves the report for the new process to continue """
+        self.record("exec", target, time.time(), 0)
+        self.report["execs"] += 1
+        self.save()
+
+    def summary(self) -> dict:
+        """ Totals per kind of event """
+        totals = {}
+        for event in self.report["events"]:
+            total = totals.setdefault(event["kind"], {"count": 0, "duration": 0})
+            total["count"] += 1
+            total["duration"] = round(total["duration"] + event["duration"], 4)
+        return totals
+
+    def save(self):
+        """ Writes the report to disk atomically and removes the oldest reports beyond retained_reports """
+        with self.lock:
+            self.report["updated"] = self.offset()
+            self.report["summary"] = self.summary()
+            os.makedirs(self.report_dir, exist_ok=True)
+            with tempfile.NamedTemporaryFile("w", dir=self.report_dir, prefix=".startup-", delete=False) as file:
+                json.dump(self.report, file, indent=2)
+            os.replace(file.name, self.report_file)
+        for old_report in sorted(glob.glob(self.report_dir + "/startup-*.json"), key=os.path.getmtime)[:-self.retained_reports]:
+            os.remove(old_report)
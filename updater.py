@@ -1,20 +1,33 @@
-import json
+import importlib
 import logging
 import os
+import shutil
 import sys
 import requests
 
 
 class Updater:
-    def __init__(self):
-        self.config = None  # A dictionary representation of JSON data describing the app
-        self.repository_raw_host_url = "https://raw.githubusercontent.com/mccolm-robotics/"
+    def __init__(self, config=None, restart=True, tracer=None):
+        self.config = config  # A dictionary representation of JSON data describing the app
+        self.restart = restart  # When False the caller owns config.txt and restarts the launcher itself
+        self.repository_raw_host_url = os.environ.get("CLAVER_REPOSITORY_RAW_HOST_URL", "https://raw.githubusercontent.com/mccolm-robotics/")
         self.launcher_repo_branch = "stable"
         self.launcher_repo_name = "ClaverLauncher"
         self.updater_log = "updater"
-        if os.path.isfile("config.txt"):    # Check to see if config file already exists
+        self.request_timeout = 30   # Seconds to wait on any single download
+        self.fetcher = None     # Shared HTTP client (fetcher.py)
+        self.object_dir = "cache/launcher"   # Downloaded launcher files, and the ones they replaced, named by their SHA-256
+        self.updated = False    # True once the launcher files match the published manifest
+        self.tracer = tracer    # Shared StartupTracer (tracer.py). Passed in when the launcher runs the updater in-process.
+        if self.config is None and os.path.isfile("config.txt"):    # Check to see if config file already exists
             self.load_config_file("config.txt")     # Read in file (JSON)
         self.setup_logging(file=logging.INFO)
+        if self.tracer is None:
+            self.tracer = self.load_launcher_module("tracer").StartupTracer()
+        self.fetcher = self.load_launcher_module("fetcher").Fetcher(timeout=self.request_timeout, logger=self.logger, tracer=self.tracer)
+        lan_cache_url = self.config.get("lan_cache_url") or os.environ.get("CLAVER_LAN_CACHE_URL")
+        if lan_cache_url:   # Same LAN cache the launcher uses (cache_server.py)
+            self.fetcher.add_mirror(self.repository_raw_host_url, lan_cache_url.rstrip("/") + "/raw/")
         # self.config["launcher_updated"] = self.launcher_repo_branch
         self.run_updater()
 
@@ -22,81 +35,109 @@ class Updater:
         """ Main entry-point of class """
         repository_url = self.repository_raw_host_url + self.launcher_repo_name + "/" + self.launcher_repo_branch
 
-        self.rename_file(current_name="init.py", new_name="old_init.py")
-        self.config["previous_launcher"] = "old_init.py"
-        self.rename_file(current_name="VERSION.txt", new_name="OLD_VERSION.txt")
-        self.config["previous_launcher_version"] = "OLD_VERSION.txt"
-        self.save_remote_file(repository_url + "/init.py", "init.py")
-        self.save_remote_file(repository_url + "/VERSION.txt", "VERSION.txt")
-
-        # Restart launcher
-        self.save_config_file()
-        module_path = os.getcwd() + "/init.py"
-        self.start_launcher(module_path)
-
-    def save_remote_file(self, url, file_name):
-        remote_file = requests.get(url)
-        if remote_file.status_code < 400:
-            with open(file_name, 'wb') as file:
+        with self.tracer.phase("replace_launcher_files"):
+            self.updated = self.apply_manifest(repository_url)
+
+        if self.restart and self.updated:
+            # Restart launcher
+            self.save_config_file()
+            module_path = os.getcwd() + "/init.py"
+            self.start_launcher(module_path)
+
+    def apply_manifest(self, repository_url) -> bool:
+        """ Brings the launcher files in line with the published MANIFEST.json. Only files whose hash differs are downloaded.
+            Every file is verified before any file is replaced, so a failed or partial download leaves the installed launcher untouched. """
+        manifest = self.fetcher.load_json(repository_url + "/MANIFEST.json")
+        if not manifest or "files" not in manifest:
+            self.logger.error("Error: Unable to download the launcher manifest. Launcher not updated.")
+            return False
+        changed = {name: digest for name, digest in manifest["files"].items() if self.fetcher.hash_file(name) != digest}
+        for name, digest in changed.items():
+            if not self.stage_file(repository_url + "/" + name, digest):
+                self.logger.error(f"Error: Unable to download a verified copy of {name}. Launcher not updated.")
+                return False
+        # VERSION.txt goes last. A swap interrupted before then is retried at the next start because the version still differs.
+        previous_files = {}
+        for name in sorted(changed, key=lambda name: name == "VERSION.txt"):
+            previous_digest = self.fetcher.hash_file(name)
+            if previous_digest is not None:     # Keep the replaced copy until the new launcher has started
+                self.keep_file(name, self.object_path(previous_digest))
+                previous_files[name] = previous_digest
+            if os.path.dirname(name):
+                os.makedirs(os.path.dirname(name), exist_ok=True)
+            os.replace(self.object_path(changed[name]), name)   # name points at a complete file before and after, even across a power loss
+            self.logger.info(f"{name} updated")
+        self.config["previous_launcher_files"] = previous_files
+        self.logger.info(f"Launcher updated to {manifest.get('version')}. {len(changed)} of {len(manifest['files'])} files changed.")
+        return True
+
+    def stage_file(self, url, digest) -> bool:
+        """ Makes sure the object store holds a copy of url whose SHA-256 is digest. A copy left by an interrupted update is reused. """
+        path = self.object_path(digest)
+        if self.fetcher.hash_file(path) == digest:
+            return True
+        if self.save_remote_file(url, path) and self.fetcher.hash_file(path) == digest:
+            return True
+        if os.path.isfile(path):
+            os.remove(path)     # Never leave an unverified file under a content address
+        return False
+
+    def keep_file(self, name, path):
+        """ Adds a second name for a launcher file without moving it, so the live name is never missing. Copies if the file system cannot hardlink. """
+        if os.path.isfile(path):
+            return  # Content-addressed. An earlier update already kept this copy.
+        try:
+            os.link(name, path)
+        except OSError:
+            shutil.copy2(name, path + ".tmp")
+            os.replace(path + ".tmp", path)
+
+    def object_path(self, digest):
+        """ Staging area for launcher files, addressed by content. It lives on the same file system as the launcher so swaps are atomic renames. """
+        os.makedirs(self.object_dir, exist_ok=True)
+        return self.object_dir + "/" + digest
+
+    def load_launcher_module(self, name):
+        """ Imports a module shared with the launcher. Launchers installed before the module existed receive a copy of it first. """
+        if not os.path.isfile(name + ".py"):
+            url = self.repository_raw_host_url + self.launcher_repo_name + "/" + self.launcher_repo_branch + "/" + name + ".py"
+            remote_file = requests.get(url, timeout=self.request_timeout)
+            remote_file.raise_for_status()
+            with open(name + ".py", 'wb') as file:
                 file.write(remote_file.content)
+        return importlib.import_module(name)
 
-    def rename_file(self, current_name, new_name):
-        os.rename(current_name, new_name)  # Rename current init file
-        self.logger.info(f"{current_name} renamed to {new_name}")
+    def save_remote_file(self, url, file_name):
+        return self.fetcher.save_remote_file(url, file_name)
 
     def load_config_file(self, config):
         """ Read in the contents of JSON file (config.txt) """
-        with open(config) as file:
-            self.config = json.load(file)
+        self.config = self.load_launcher_module("config_store").ConfigStore.load(config)
 
     def save_config_file(self):
-        """ Save config information in JSON format to config.txt """
-        with open('config.txt', 'w') as outfile:
-            json.dump(self.config, outfile, indent=2, sort_keys=True)
+        """ Save config information in JSON format to config.txt. Nothing is written if the contents are unchanged. """
+        if not hasattr(self.config, "save"):    # Launchers older than config_store.py pass in a plain dictionary
+            self.config = self.load_launcher_module("config_store").ConfigStore(self.config)
+        self.config.save()
 
     def setup_logging(self, console=logging.INFO, file=logging.WARNING):
-        """ Set logger to capture different levels of information. Data logged to file differs (depending on settings) from data displayed to the console (stdout). """
-        if not os.path.isdir("logs"):   # Check to see if the logs directory exists
-            os.mkdir("logs")    # Create the directory
-        if os.path.isfile('logs/' + self.updater_log + '.log'):  # Logs will be retained on a per-run basis. Delete log from previous run.
-            os.remove('logs/' + self.updater_log + '.log')
-
-        self.config["updater_log_file"] = self.updater_log + '.log'
-
-        # Reset any previous locks on the logger
-        logging.getLogger().setLevel(logging.DEBUG)
-        logger = logging.getLogger('')
-        logger.handlers = []
-
+        """ Set logger to capture different levels of information. Run from the launcher, the updater shares its log pipeline (log_pipeline.py). Run on its own, it writes logs/updater.log. """
+        self.load_launcher_module("log_pipeline").LogPipeline.setup(self.updater_log, console=console, file=file)
         self.logger = logging.getLogger(__name__)   # Set logger to name of module
-        # Create handlers
-        c_handler = logging.StreamHandler(stream=sys.stdout)    # Create console logger
-        f_handler = logging.FileHandler('logs/' + self.updater_log + '.log')    # Create file logger
-        c_handler.setLevel(console)     # Set logging level for console logger
-        f_handler.setLevel(file)        # Set logging level for file logger
-
-        # Create formatters and add them to handlers
-        c_format = logging.Formatter('%(message)s')
-        f_format = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        c_handler.setFormatter(c_format)
-        f_handler.setFormatter(f_format)
-
-        # Add handlers to the logger
-        self.logger.addHandler(c_handler)
-        self.logger.addHandler(f_handler)
-
-        self.logger.info(f'Log initialized for {self.updater_log}') # The minimum logging level for the file logger is set to WARNING
+        self.logger.info(f'Log initialized for {self.updater_log}')
 
     def start_launcher(self, path):
         """ Restarts the current program """
         import psutil
+        self.load_launcher_module("log_pipeline").LogPipeline.shutdown()   # Writes out queued records before the process image is replaced
         try:
             p = psutil.Process(os.getpid())
             for handler in p.open_files() + p.connections():
                 os.close(handler.fd)
         except Exception as e:
-            self.logger.error("Error: Unable to close files and connections held by process", exc_info=True)
+            print("Error: Unable to close files and connections held by process", e)
 
+        self.tracer.record_exec(path)   # The relaunched launcher continues the same timing report
         python = sys.executable
         os.execl(python, python, path)  # Relaunch application
 
@@ -0,0 +1,121 @@
+import hashlib
+import logging
+import os
+import re
+import shutil
+import tempfile
+import time
+
+VERSION_DIR = re.compile(r"^t(\d+)$")     # Versions of the app are checked out into t<clock> directories
+
+
+class VersionStore:
+    """ Manages the t<clock> directories that hold installed versions of the app. Keeps the versions in use and the newest retained_versions,
+        deletes the rest and hardlinks files that are identical across versions into a shared pool, so each new version only adds the files that changed. """
+    def __init__(self, root=".", store_dir="cache/versions", retained_versions=2, logger=None, tracer=None):
+        self.root = root    # Directory holding the t<clock> directories
+        self.objects_dir = store_dir + "/objects"  # One hardlink per distinct file, named by SHA-256 and mode
+        self.trash_dir = store_dir + "/trash"   # Versions moved out of root. Deleted by collect().
+        self.retained_versions = retained_versions  # Versions kept counting the active one, besides those config.txt still refers to
+        self.excluded = {".git", "interface"}   # Not deduplicated. The app may rewrite files in interface/ in place.
+        self.logger = logger or logging.getLogger(__name__)
+        self.tracer = tracer
+        self.verified_objects = set()   # Pool entries checked against their name during this collect()
+
+    def list_versions(self) -> list:
+        """ Returns every t<clock> directory in root, oldest first """
+        names = [name for name in os.listdir(self.root) if VERSION_DIR.match(name) and os.path.isdir(os.path.join(self.root, name))]
+        return sorted(names, key=lambda name: int(VERSION_DIR.match(name).group(1)))
+
+    def remove(self, app_dir):
+        """ Moves a version (or any directory below root) out of root at once. A single rename, so an interrupted removal never leaves a partial version behind. Its files are deleted by collect(). """
+        if not os.path.isdir(os.path.join(self.root, app_dir)):
+            return
+        os.makedirs(self.trash_dir, exist_ok=True)
+        os.rename(os.path.join(self.root, app_dir), os.path.join(tempfile.mkdtemp(dir=self.trash_dir), os.path.basename(app_dir)))
+        self.logger.info(f"Removed {app_dir}")
+
+    def collect(self, active, protected):
+        """ Removes every version that is neither protected nor one of the retained_versions newest up to active, including leftovers of failed or interrupted
+            upgrades. Deduplicates the versions that remain and deletes what has been removed. """
+        started = time.time()
+        clock = time.monotonic()
+        self.verified_objects = set()
+        versions = self.list_versions()
+        keep = set(protected) | {active}
+        active_clock = int(VERSION_DIR.match(active).group(1)) if VERSION_DIR.match(active) else 0
+        older = [name for name in versions if name not in keep and int(VERSION_DIR.match(name).group(1)) < active_clock]
+        if self.retained_versions > 1:
+            keep.update(older[-(self.retained_versions - 1):])
+        for name in versions:
+            if name not in keep:
+                self.remove(name)   # Older than the retained versions, or newer than active without being referenced (a failed upgrade)
+        saved = sum(self.dedupe(name) for name in versions if name in keep and os.path.isdir(os.path.join(self.root, name)))
+        self.empty_trash()
+        self.prune_objects()
+        self.logger.info(f"Versions kept: {', '.join(name for name in versions if name in keep)}. Deduplication saved {saved} bytes.")
+        if self.tracer is not None:
+            self.tracer.record("phase", "collect_versions", started, time.monotonic() - clock)
+
+    def dedupe(self, app_dir) -> int:
+        """ Replaces each file of a version with a hardlink to the identical file in the pool. Returns the number of bytes freed. """
+        saved = 0
+        os.makedirs(self.objects_dir, exist_ok=True)
+        for directory, dirs, files in os.walk(os.path.join(self.root, app_dir)):
+            if directory == os.path.join(self.root, app_dir):
+                dirs[:] = [name for name in dirs if name not in self.excluded]
+            for name in files:
+                path = os.path.join(directory, name)
+                status = os.lstat(path)
+                if not os.path.isfile(path) or os.path.islink(path) or status.st_nlink > 1:
+                    continue    # Already linked into the pool
+                digest = self.hash_file(path)
+                object_path = self.objects_dir + "/" + digest + "-" + oct(status.st_mode & 0o777)[2:]
+                try:
+                    if not self.is_object_valid(object_path, digest):
+                        if os.path.exists(object_path + ".new"):
+                            os.remove(object_path + ".new")     # Left by an interrupted collect()
+                        os.link(path, object_path + ".new")
+                        os.replace(object_path + ".new", object_path)   # First copy of this content, or a stale entry. It becomes the pool entry.
+                        self.verified_objects.add(object_path)
+                        continue
+                    link = path + ".dedupe"
+                    os.link(object_path, link)
+                    os.replace(link, path)  # Atomic. A running app reading the file sees the same content either way.
+                    saved += status.st_size
+                except OSError:
+                    self.logger.warning(f"Unable to hardlink {path}. Leaving it as a copy.")
+                    return saved
+        return saved
+
+    def is_object_valid(self, object_path, digest) -> bool:
+        """ True if the pool entry exists and still holds the content it is named after. An app that rewrites one of its files in place
+            changes the shared inode, so the entry is hashed again before anything more is linked to it. """
+        if object_path in self.verified_objects:
+            return True
+        if not os.path.exists(object_path):
+            return False
+        if self.hash_file(object_path) != digest:
+            self.logger.warning(f"{object_path} was modified in place. Replacing it.")
+            return False
+        self.verified_objects.add(object_path)
+        return True
+
+    def empty_trash(self):
+        if os.path.isdir(self.trash_dir):
+            for name in os.listdir(self.trash_dir):
+                shutil.rmtree(os.path.join(self.trash_dir, name), ignore_errors=True)
+
+    def prune_objects(self):
+        """ Deletes pool entries that no version links to any more """
+        if os.path.isdir(self.objects_dir):
+            for name in os.listdir(self.objects_dir):
+                if os.stat(os.path.join(self.objects_dir, name)).st_nlink == 1:
+                    os.remove(os.path.join(self.objects_dir, name))
+
+    def hash_file(self, path):
+        digest = hashlib.sha256()
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(65536), b""):
+                digest.update(chunk)
+        return digest.hexdigest()